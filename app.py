@@ -1,8 +1,24 @@
-from flask import Flask, render_template, request, redirect, url_for, session, g
-import sqlite3
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, g
+import atexit
+import math
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import google.auth
-from google.cloud.retail import SearchRequest, SearchServiceClient
+from google.cloud.retail import SearchRequest
+
+import db
+from inventory import Inventory
+import local_search
+import orders
+from cart_pricing import price_cart
+from catalog import LISTING_SORTS, NO_FILTER, Catalog, ProductFilter, list_products, load_details
+import query_normalize
+from raw_index import RawIndex, index_path_for as raw_index_path_for
+import vertex_search
+from search_cache import SearchCache, SearchResult, SingleFlight
+from session_store import ServerSideSessionInterface, create_store as create_session_store
 
 app = Flask(__name__)
 app.secret_key = 'super_secret_key_for_demo'  # Replace in production
@@ -12,76 +28,329 @@ DB_PATH = 'ecommerce.db'
 app.config['GTM_ID'] = 'GTM-NFMZ6FZJ' # Updated based on user request
 app.config['VISITOR_ID'] = 'visitor-12345' # Demo visitor ID
 
+# Search backend: 'vertex' (Vertex AI Search, falls back to local on errors)
+# or 'local' (SQLite FTS only, no Google credentials needed)
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'vertex')
+
 # Vertex AI Search Settings
-PROJECT_ID = google.auth.default()[1] # Try to get from ADC
+if app.config['SEARCH_BACKEND'] == 'vertex':
+    PROJECT_ID = google.auth.default()[1] # Try to get from ADC
+else:
+    PROJECT_ID = os.environ.get('GOOGLE_CLOUD_PROJECT', '')
 DEFAULT_SEARCH_PLACEMENT = f"projects/{PROJECT_ID}/locations/global/catalogs/default_catalog/placements/default_search"
 
-def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row
-    return db
+# Home page listing
+AVAILABILITY_VALUES = ('IN_STOCK', 'OUT_OF_STOCK', 'PREORDER', 'BACKORDER')
+app.config['HOME_PAGE_SIZE'] = int(os.environ.get('HOME_PAGE_SIZE', '48'))
+
+# Original feed for raw record lookups (/_raw/<id>); the offset index lives next to the DB
+app.config['RAW_FEED'] = os.environ.get('RAW_FEED', 'products_data.jsonl')
+
+# Session storage: 'cookie' (Flask's signed cookie, the default), 'sqlite' (server-side,
+# SESSION_DB with WAL) or 'memory' (in-process, per worker). Server-side backends keep only
+# the session ID in the cookie, but both are local to one instance: on Cloud Run requests
+# land on different instances and carts would disappear. Keep 'cookie' there until a
+# shared store (e.g. Redis) is available
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'cookie')
+app.config['SESSION_DB'] = os.environ.get('SESSION_DB', 'sessions.db')
+
+# Orders are written by a background thread in group commits (write-behind)
+app.config['ORDERS_DB'] = os.environ.get('ORDERS_DB', 'orders.db')
+app.config['ORDER_QUEUE_SIZE'] = int(os.environ.get('ORDER_QUEUE_SIZE', '1000'))
+app.config['ORDER_BATCH_SIZE'] = int(os.environ.get('ORDER_BATCH_SIZE', '100'))
+# Stock lives in its own database so reservations never wait behind the order
+# writer's synchronous=FULL group commits (SQLite allows one writer per file)
+app.config['INVENTORY_DB'] = os.environ.get('INVENTORY_DB', 'inventory.db')
+
+# Search result cache (per worker)
+app.config['SEARCH_PAGE_SIZE'] = 10
+app.config['SEARCH_CACHE_SIZE'] = int(os.environ.get('SEARCH_CACHE_SIZE', '1024'))
+app.config['SEARCH_CACHE_TTL'] = int(os.environ.get('SEARCH_CACHE_TTL', '300'))  # seconds
+
+# Fold hiragana into katakana when normalizing queries (e.g. ぱーかー -> パーカー)
+app.config['SEARCH_KANA_NORMALIZE'] = os.environ.get('SEARCH_KANA_NORMALIZE', '0') == '1'
+
+# Prefetch the next search page into the cache while the current one renders
+app.config['SEARCH_PREFETCH'] = os.environ.get('SEARCH_PREFETCH', '1') == '1'
+# Prefetches queued or running at once; further ones are dropped
+app.config['SEARCH_PREFETCH_MAX_PENDING'] = int(os.environ.get('SEARCH_PREFETCH_MAX_PENDING', '4'))
+
+# Search stage deadline and circuit breaker (seconds)
+app.config['SEARCH_DEADLINE'] = float(os.environ.get('SEARCH_DEADLINE', '2.0'))
+app.config['SEARCH_SLOW_CALL'] = float(os.environ.get('SEARCH_SLOW_CALL', '1.0'))
+app.config['SEARCH_BREAKER_FAILURES'] = int(os.environ.get('SEARCH_BREAKER_FAILURES', '5'))
+app.config['SEARCH_BREAKER_RESET'] = float(os.environ.get('SEARCH_BREAKER_RESET', '30'))
+
+# Hedged requests (optional): re-send a search that is slower than the
+# given latency percentile, adding at most SEARCH_HEDGE_MAX_RATIO extra load
+app.config['SEARCH_HEDGE'] = os.environ.get('SEARCH_HEDGE', '0') == '1'
+app.config['SEARCH_HEDGE_PERCENTILE'] = float(os.environ.get('SEARCH_HEDGE_PERCENTILE', '95'))
+app.config['SEARCH_HEDGE_MAX_RATIO'] = float(os.environ.get('SEARCH_HEDGE_MAX_RATIO', '0.1'))
+# Threads for first attempts (match gunicorn --threads) and for hedges; a hedge is
+# skipped when all hedge threads are busy, so first attempts never queue behind hedges
+app.config['SEARCH_HEDGE_WORKERS'] = int(os.environ.get('SEARCH_HEDGE_WORKERS', '8'))
+app.config['SEARCH_HEDGE_MAX_INFLIGHT'] = int(os.environ.get('SEARCH_HEDGE_MAX_INFLIGHT', '2'))
+
+# ワーカー起動時に検索クライアントを作成し、全リクエストで使い回す
+if app.config['SEARCH_BACKEND'] == 'vertex':
+    vertex_search.init_clients()
+search_breaker = vertex_search.CircuitBreaker(
+    failure_threshold=app.config['SEARCH_BREAKER_FAILURES'],
+    reset_timeout=app.config['SEARCH_BREAKER_RESET'],
+    slow_call_threshold=app.config['SEARCH_SLOW_CALL'])
+search_hedger = None
+if app.config['SEARCH_HEDGE']:
+    search_hedger = vertex_search.Hedger(
+        percentile=app.config['SEARCH_HEDGE_PERCENTILE'],
+        max_ratio=app.config['SEARCH_HEDGE_MAX_RATIO'],
+        max_workers=app.config['SEARCH_HEDGE_WORKERS'],
+        max_hedges=app.config['SEARCH_HEDGE_MAX_INFLIGHT'])
+search_cache = SearchCache(maxsize=app.config['SEARCH_CACHE_SIZE'],
+                           ttl=app.config['SEARCH_CACHE_TTL'])
+search_flight = SingleFlight()
+search_prefetcher = ThreadPoolExecutor(max_workers=2, thread_name_prefix='search-prefetch')
+search_prefetch_slots = threading.BoundedSemaphore(app.config['SEARCH_PREFETCH_MAX_PENDING'])
+
+# 読み取り系はインメモリのカタログスナップショットから引く(DB 更新時は自動で再読み込み)
+catalog = Catalog(DB_PATH)
+# 差分フィード(ingest.py --delta)で変わった商品を含む検索結果はキャッシュから外す
+catalog.on_change(search_cache.invalidate_products)
+
+# サーバー側セッションを選んだ場合は、Cookie にはセッション ID だけを入れる
+session_store = create_session_store(app.config['SESSION_BACKEND'], app.config['SESSION_DB'])
+if session_store is not None:
+    app.session_interface = ServerSideSessionInterface(session_store)
+    if os.environ.get('K_SERVICE'):
+        # Cloud Run ではインスタンスごとに別のストアになり、カートが消える
+        print(f"WARNING: SESSION_BACKEND={app.config['SESSION_BACKEND']} is local to this instance; "
+              f"sessions are not shared between Cloud Run instances")
 
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+# 注文はキューに入れてバックグラウンドでまとめて書き込む。終了時に残りを書き切る
+order_writer = orders.OrderWriter(app.config['ORDERS_DB'],
+                                  maxsize=app.config['ORDER_QUEUE_SIZE'],
+                                  batch_size=app.config['ORDER_BATCH_SIZE'])
+atexit.register(order_writer.close)
 
-def search_vertex_ai(query):
+# 在庫(inventory.db)。購入確定時に注文の全明細をまとめて引き当てる
+inventory = Inventory(app.config['INVENTORY_DB'])
+
+# 元レコードを id で引くための mmap 索引(初回アクセス時に開く)
+raw_products = RawIndex(app.config['RAW_FEED'], raw_index_path_for(DB_PATH))
+
+def current_snapshot():
+    # 1 リクエストの中では同じスナップショットを使う(途中で差し替わっても一貫した表示にする)
+    if 'catalog_snapshot' not in g:
+        g.catalog_snapshot = catalog.snapshot()
+    return g.catalog_snapshot
+
+def current_cart_pricing():
+    # セッションのカートの明細と金額。同じリクエスト内でカートが変わらなければ再計算しない
+    cart_session = session.get('cart', {})
+    key = tuple(cart_session.items())
+    cached = g.get('cart_pricing')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    priced = price_cart(cart_session, current_snapshot())
+    g.cart_pricing = (key, priced)
+    return priced
+
+def get_db(readonly=True):
+    # スレッドごとに使い回す接続(リクエスト終了時には閉じない)
+    return db.get_connection(DB_PATH, readonly=readonly)
+
+def search_vertex_ai(query, timeout=None, page_token='', offset=0, filter_expr='', order_by=''):
     search_request = SearchRequest()
     search_request.placement = DEFAULT_SEARCH_PLACEMENT
     search_request.query = query
     search_request.visitor_id = app.config['VISITOR_ID']
-    search_request.page_size = 10
+    search_request.page_size = app.config['SEARCH_PAGE_SIZE']
+    if filter_expr:
+        search_request.filter = filter_expr
+    if order_by:
+        search_request.order_by = order_by
+    if page_token:
+        search_request.page_token = page_token
+    elif offset:
+        search_request.offset = offset
     
-    client = SearchServiceClient()
-    response = client.search(search_request)
-    return response
+    def call(remaining):
+        # ヘッジ時は呼び出しごとにプール内の別クライアント(チャネル)を使う
+        client = vertex_search.get_client()
+        return client.search(search_request, timeout=remaining)
+
+    if search_hedger is not None and timeout is not None:
+        # 2 本目は締め切りまでの残り時間だけで呼ぶ(timeout を延長しない)
+        return search_hedger.call(call, time.monotonic() + timeout)
+    return call(timeout)
+
+def normalize_query(query):
+    return query_normalize.normalize_query(query, kana=app.config['SEARCH_KANA_NORMALIZE'])
+
+def search_key(query, page, filters, sort):
+    return (normalize_query(query), DEFAULT_SEARCH_PLACEMENT, app.config['SEARCH_PAGE_SIZE'],
+            filters, sort, page)
+
+def search_local(query, page=1, filters=NO_FILTER, sort='relevance'):
+    page_size = app.config['SEARCH_PAGE_SIZE']
+    return local_search.search(get_db(), normalize_query(query), limit=page_size,
+                               offset=(page - 1) * page_size, filters=filters, sort=sort)
+
+def search_products(query, page=1, filters=NO_FILTER, sort='relevance'):
+    if app.config['SEARCH_BACKEND'] == 'local':
+        return search_local(query, page, filters, sort)
+    # 検索ステージ全体の締め切り。Vertex AI が遅くてもスレッドを占有し続けない
+    deadline = time.monotonic() + app.config['SEARCH_DEADLINE']
+    try:
+        result = search_vertex_cached(query, page, deadline, filters, sort)
+    except Exception as e:
+        # Vertex AI が失敗してもページを空にせず、ローカル検索の結果を返す
+        # (フォールバック結果はキャッシュしない)
+        print(f"Vertex AI Search failed, falling back to local search: {e!r}")
+        return search_local(query, page, filters, sort)
+    if result.next_page_token and app.config['SEARCH_PREFETCH']:
+        prefetch_search_page(query, page + 1, filters, sort)
+    return result
+
+def search_vertex_cached(query, page, deadline, filters=NO_FILTER, sort='relevance'):
+    # page_token は同じリクエスト内容でしか使えないため、
+    # キャッシュキーと同じ正規化済みクエリで Vertex AI に問い合わせる
+    query = normalize_query(query)
+    key = search_key(query, page, filters, sort)
+    result = search_cache.get(key)
+    if result is not None:
+        return result
+
+    def fetch():
+        # 同時に同じクエリが来た場合、待っている間に先行リクエストが
+        # キャッシュを埋めているかもしれないので再確認する
+        cached = search_cache.peek(key)
+        if cached is not None:
+            return cached
+        # 前のページの next_page_token が分かればそれを使い、
+        # 分からない(直接 page=N に来た)場合は offset で取得する
+        page_token = ''
+        if page > 1:
+            previous = search_cache.peek(search_key(query, page - 1, filters, sort))
+            if previous is not None:
+                page_token = previous.next_page_token
+        offset = (page - 1) * app.config['SEARCH_PAGE_SIZE']
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('Search deadline exceeded before calling Vertex AI')
+        response = search_breaker.call(lambda: search_vertex_ai(
+            query, timeout=remaining, page_token=page_token, offset=offset,
+            filter_expr=vertex_search.build_filter(filters),
+            order_by=vertex_search.SEARCH_ORDER_BY[sort]))
+        # 1. IDの取得先を result.id に修正
+        # 文字列としてリスト化します
+        fetched = SearchResult(
+            product_ids=tuple(str(r.id) for r in response.results),
+            attribution_token=response.attribution_token,
+            next_page_token=response.next_page_token,
+            total_size=response.total_size)
+        search_cache.set(key, fetched)
+        return fetched
+
+    return search_flight.do(key, fetch, timeout=max(0.0, deadline - time.monotonic()))
+
+def prefetch_search_page(query, page, filters, sort):
+    # 次のページをバックグラウンドでキャッシュに載せておく。
+    # 取得中にユーザーが「次へ」を押しても single-flight で合流する。
+    # Vertex AI が不調(ブレーカーが closed 以外)のときや、待ちが上限に達しているときは
+    # 先読みしない(キューを溜めて古い先読みで API の割り当てを使わないように)
+    if search_breaker.state != vertex_search.CircuitBreaker.CLOSED:
+        return
+    if search_cache.peek(search_key(query, page, filters, sort)) is not None:
+        return
+    if not search_prefetch_slots.acquire(blocking=False):
+        return
+    # 締め切りは投入した時点から数える。待たされて過ぎていれば呼び出さない
+    deadline = time.monotonic() + app.config['SEARCH_DEADLINE']
+
+    def run():
+        try:
+            if time.monotonic() < deadline:
+                search_vertex_cached(query, page, deadline, filters, sort)
+        except Exception as e:
+            print(f"Prefetch of page {page} for {query!r} failed: {e!r}")
+        finally:
+            search_prefetch_slots.release()
+
+    try:
+        search_prefetcher.submit(run)
+    except RuntimeError:
+        # 終了処理中
+        search_prefetch_slots.release()
+
+def listing_sort(searching=False):
+    sorts, default = (vertex_search.SEARCH_ORDER_BY, 'relevance') if searching else (LISTING_SORTS, 'category')
+    sort = request.args.get('sort', default)
+    return sort if sort in sorts else default
+
+def price_arg(name):
+    # 価格の絞り込み。inf/nan や負の値は指定なしとして扱う
+    value = request.args.get(name, type=float)
+    if value is None or not math.isfinite(value) or value < 0:
+        return None
+    return value
+
+def parse_filters():
+    min_price = price_arg('min_price')
+    max_price = price_arg('max_price')
+    availability = request.args.get('availability')
+    if availability not in AVAILABILITY_VALUES:
+        availability = None
+    return ProductFilter(min_price, max_price, availability)
+
+def filter_args(sort, filters):
+    # ページ送りのリンクに今の並び順・絞り込み条件を引き継ぐ
+    args = dict(request.view_args or {})
+    if sort not in ('category', 'relevance'):
+        args['sort'] = sort
+    for name, value in filters._asdict().items():
+        if value is not None:
+            args[name] = value
+    return args
+
+def listing_page(sort, filters, category=None):
+    listing = list_products(get_db(), sort=sort,
+                            after=request.args.get('after'),
+                            before=request.args.get('before'),
+                            limit=app.config['HOME_PAGE_SIZE'],
+                            category=category,
+                            filters=filters)
+    snapshot = current_snapshot()
+    products = [p for p in map(snapshot.get, listing.product_ids) if p is not None]
+    return listing, products
 
 @app.route('/')
 def index():
     query = request.args.get('q', '')
+    page = max(1, request.args.get('page', 1, type=int))
+    sort = listing_sort(searching=bool(query))
+    filters = parse_filters()
+    listing = None
     products = []
     attribution_token = None
+    has_next = False
     
     if query:
         try:
-            print(f"Searching for: {query}")
-            response = search_vertex_ai(query)
-            attribution_token = response.attribution_token
-            
-            # 1. IDの取得先を result.id に修正
-            # 文字列としてリスト化します
-            vertex_ids = [str(result.id) for result in response.results]
+            print(f"Searching for: {query} (page {page})")
+            result = search_products(query, page, filters, sort)
+            attribution_token = result.attribution_token
+            has_next = bool(result.next_page_token)
+            vertex_ids = list(result.product_ids)
             print(f"Extracted IDs: {vertex_ids}")
 
-            if vertex_ids:
-                conn = get_db()
-                # SQLのIN句で一括取得
-                placeholders = ', '.join(['?'] * len(vertex_ids))
-                query_sql = f'SELECT * FROM products WHERE id IN ({placeholders})'
-                
-                db_results = conn.execute(query_sql, vertex_ids).fetchall()
-                
-                # 2. 検索結果の順序（Vertex AIのスコア順）を維持するための処理
-                # DBから取得した行をIDをキーにした辞書に変換
-                product_map = {str(row['id']): row for row in db_results}
-                
-                for v_id in vertex_ids:
-                    if v_id in product_map:
-                        row = product_map[v_id]
-                        # テンプレートに渡す形式に変換する
-                        products.append({
-                            'id': row['id'],
-                            'title': row['title'],
-                            'category': row['category'],
-                            'price': row['price'],
-                            'image_url': row['image_url']
-                        })
-                    else:
-                        print(f"ID {v_id} found in Vertex AI but NOT in Local DB")
+            # 検索結果の順序（Vertex AIのスコア順）を維持したままスナップショットから引く
+            snapshot = current_snapshot()
+            for v_id in vertex_ids:
+                product = snapshot.get(v_id)
+                if product is not None:
+                    products.append(product)
+                else:
+                    print(f"ID {v_id} found in Vertex AI but NOT in Local DB")
 
             print(f"Final products count: {len(products)}")
                 
@@ -92,84 +361,140 @@ def index():
             
     else:
         # デフォルト表示（クエリなしの場合）
-        conn = get_db()
-        db_products = conn.execute('SELECT * FROM products').fetchall()
-        products = [dict(row) for row in db_products]
+        # 全件ではなく 1 ページ分だけをキーセットページネーションで表示する
+        listing, products = listing_page(sort, filters)
     
     return render_template('index.html', 
                            products=products, 
                            query=query, 
                            attribution_token=attribution_token,
+                           page=page,
+                           has_next=has_next,
+                           listing=listing,
+                           sort=sort,
+                           filters=filters,
+                           filter_args=filter_args(sort, filters),
+                           categories=current_snapshot().categories,
+                           offset=(page - 1) * app.config['SEARCH_PAGE_SIZE'],
+                           visitor_id=app.config.get('VISITOR_ID'))
+
+@app.route('/category/<name>')
+def category(name):
+    categories = current_snapshot().categories
+    if name not in categories:
+        return "Category not found", 404
+    sort = listing_sort()
+    filters = parse_filters()
+    # product_categories の (category, ...) 索引の範囲スキャンで 1 ページ分だけ取る
+    listing, products = listing_page(sort, filters, category=name)
+    return render_template('index.html',
+                           products=products,
+                           query='',
+                           attribution_token=None,
+                           page=1,
+                           has_next=False,
+                           offset=0,
+                           listing=listing,
+                           sort=sort,
+                           filters=filters,
+                           filter_args=filter_args(sort, filters),
+                           category=name,
+                           categories=categories,
                            visitor_id=app.config.get('VISITOR_ID'))
 
 @app.route('/product/<product_id>')
 def detail(product_id):
-    conn = get_db()
-    product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
+    product = current_snapshot().get(product_id)
     if product is None:
         return "Product not found", 404
-    return render_template('detail.html', product=product)
+    # 一覧に要らない属性(全画像・タグ・商品ページ URL)は詳細ページでだけ引く
+    details = load_details(get_db(), product_id)
+    return render_template('detail.html', product=product, details=details)
 
 @app.route('/cart')
 def cart():
-    cart_session = session.get('cart', {})
-    cart_items = []
-    total_price = 0
-    conn = get_db()
-    
-    # We need to know the currency code. Assuming all products have the same currency for now,
-    # or we can pass it per item. But for total, we need to be careful if currencies mix.
-    # The dataset seems to be all USD.
-    currency_code = 'USD' # Default fallback
-    
-    for pid, qty in cart_session.items():
-        if qty > 0:
-            product = conn.execute('SELECT * FROM products WHERE id = ?', (pid,)).fetchone()
-            if product:
-                item_total = product['price'] * qty
-                total_price += item_total
-                cart_items.append({
-                    'product': product,
-                    'quantity': qty,
-                    'item_total': item_total
-                })
-                # Capture currency from one of the products
-                currency_code = product['currency_code']
-    
+    priced = current_cart_pricing()
+
     # Check for last_added_item for GTM event
     last_added_item = session.pop('last_added_item', None)
     print(f"DEBUG: Retrieved last_added_item from session: {last_added_item}")
+
+    # 購入確定で在庫が足りなかった商品 {product_id: 残り在庫}
+    stock_shortage = session.pop('stock_shortage', None)
     
     return render_template('cart.html', 
-                           cart_items=cart_items, 
-                           total_price=total_price, 
-                           currency_code=currency_code,
-                           last_added_item=last_added_item)
+                           cart_items=priced.lines, 
+                           total_price=priced.total_price, 
+                           currency_code=priced.currency_code,
+                           totals=priced.totals,
+                           mixed_currency=priced.mixed_currency,
+                           last_added_item=last_added_item,
+                           stock_shortage=stock_shortage)
+
+def add_item_to_cart(product_id, quantity):
+    # カートに追加し、GTM の add-to-cart イベント用の商品情報を返す(商品が無ければ None)
+    cart_session = session.get('cart', {})
+    current_qty = cart_session.get(product_id, 0)
+    cart_session[product_id] = current_qty + quantity
+    session['cart'] = cart_session
+
+    product = current_snapshot().get(product_id)
+    if product is None:
+        return None
+    return {
+        'id': product['id'],
+        'price': product['price'],
+        'name': product['title'],
+        'category': product['category'],
+        'currency_code': product['currency_code'],
+        'quantity': quantity
+    }
+
+def update_cart_item(product_id, action, quantity=None):
+    # action: 'update'(quantity が 0 以下なら削除)または 'delete'
+    cart_session = session.get('cart', {})
+
+    if product_id in cart_session:
+        if action == 'delete':
+            del cart_session[product_id]
+        elif action == 'update' and quantity is not None:
+            if quantity > 0:
+                cart_session[product_id] = quantity
+            else:
+                del cart_session[product_id]
+
+    session['cart'] = cart_session
+
+def cart_summary():
+    # JSON API で返すカートの内容(ページ側でその場で書き換える)
+    priced = current_cart_pricing()
+    return {
+        'items': [{
+            'id': line.product['id'],
+            'title': line.product['title'],
+            'price': line.product['price'],
+            'currency_code': line.product['currency_code'],
+            'quantity': line.quantity,
+            'item_total': line.item_total,
+        } for line in priced.lines],
+        'item_count': sum(line.quantity for line in priced.lines),
+        # 通貨が混ざっていれば total_price / currency_code は null で、totals だけが入る
+        'total_price': priced.total_price,
+        'currency_code': priced.currency_code,
+        'totals': priced.totals,
+        'mixed_currency': priced.mixed_currency,
+    }
 
 @app.route('/add_to_cart', methods=['POST'])
 def add_to_cart():
     product_id = request.form.get('product_id')
     # Default to 1 if not specified
     quantity = int(request.form.get('quantity', 1))
-    
-    cart_session = session.get('cart', {})
-    current_qty = cart_session.get(product_id, 0)
-    cart_session[product_id] = current_qty + quantity
-    session['cart'] = cart_session
-    
+
     # Store added item details in session for GTM event on next page load
-    conn = get_db()
-    product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
-    if product:
-        session['last_added_item'] = {
-            'id': product['id'],
-            'price': product['price'],
-            'name': product['title'],
-            'category': product['category'],
-            'currency_code': product['currency_code'],
-            'quantity': quantity
-        }
-        session.modified = True # Ensure session is saved
+    last_added_item = add_item_to_cart(product_id, quantity)
+    if last_added_item:
+        session['last_added_item'] = last_added_item
         print(f"DEBUG: Stored last_added_item in session: {session['last_added_item']}")
     else:
         print(f"DEBUG: Product {product_id} not found, cannot store in session.")
@@ -180,53 +505,123 @@ def add_to_cart():
 def update_cart():
     product_id = request.form.get('product_id')
     action = request.form.get('action')
-    
-    cart_session = session.get('cart', {})
-    
-    if product_id in cart_session:
-        if action == 'delete':
-            del cart_session[product_id]
-        elif action == 'update':
-            try:
-                new_qty = int(request.form.get('quantity'))
-                if new_qty > 0:
-                    cart_session[product_id] = new_qty
-                else:
-                    del cart_session[product_id]
-            except ValueError:
-                pass
-    
-    session['cart'] = cart_session
+    try:
+        quantity = int(request.form.get('quantity'))
+    except (TypeError, ValueError):
+        quantity = None
+
+    update_cart_item(product_id, action, quantity)
     return redirect(url_for('cart'))
 
+# カート操作の JSON API。リダイレクトせず、更新後のカートをそのまま返す。
+# add-to-cart の dataLayer イベントはレスポンスの added を使ってページ側で送る
+def api_params():
+    # JSON ならオブジェクトだけを受け付ける(配列・文字列・壊れた JSON は None → 400)
+    if request.is_json:
+        params = request.get_json(silent=True)
+        return params if isinstance(params, dict) else None
+    return request.form
+
+def api_quantity(params, default=None):
+    value = params.get('quantity', default)
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+@app.route('/api/cart')
+def api_cart():
+    return jsonify(cart_summary())
+
+@app.route('/api/cart/items', methods=['POST'])
+def api_add_to_cart():
+    params = api_params()
+    if params is None:
+        return jsonify(error='Request body must be a JSON object'), 400
+    product_id = params.get('product_id')
+    quantity = api_quantity(params, 1)
+    if not isinstance(product_id, str) or not product_id or quantity is None or quantity <= 0:
+        return jsonify(error='product_id and a positive quantity are required'), 400
+    if current_snapshot().get(product_id) is None:
+        return jsonify(error='Product not found'), 404
+    added = add_item_to_cart(product_id, quantity)
+    summary = cart_summary()
+    summary['added'] = added
+    return jsonify(summary)
+
+@app.route('/api/cart/items/<product_id>', methods=['PATCH', 'PUT'])
+def api_update_cart_item(product_id):
+    params = api_params()
+    if params is None:
+        return jsonify(error='Request body must be a JSON object'), 400
+    quantity = api_quantity(params)
+    if quantity is None:
+        return jsonify(error='quantity is required'), 400
+    update_cart_item(product_id, 'update', quantity)
+    return jsonify(cart_summary())
+
+@app.route('/api/cart/items/<product_id>', methods=['DELETE'])
+def api_delete_cart_item(product_id):
+    update_cart_item(product_id, 'delete')
+    return jsonify(cart_summary())
+
 @app.route('/complete')
 def complete():
     # Capture revenue and items before clearing cart for GTM purchase event
-    cart_session = session.get('cart', {})
-    conn = get_db()
-    
-    order_items = []
-    total_price = 0
-    currency_code = 'USD'
-    
-    for pid, qty in cart_session.items():
-        if qty > 0:
-            product = conn.execute('SELECT * FROM products WHERE id = ?', (pid,)).fetchone()
-            if product:
-                item_total = product['price'] * qty
-                total_price += item_total
-                order_items.append({
-                    'product': dict(product), # Convert Row to dict for safer template usage if needed
-                    'quantity': qty
-                })
-                currency_code = product['currency_code']
+    priced = current_cart_pricing()
+
+    order_id = None
+    if priced.mixed_currency:
+        # 通貨の混ざったカートは 1 つの合計で注文できない。カートに戻す(カートに案内が出る)
+        app.logger.warning('Rejected checkout of a mixed-currency cart: %s', sorted(priced.totals))
+        return redirect(url_for('cart'))
+    if priced.lines:
+        lines = [(line.product['id'], line.quantity) for line in priced.lines]
+        shortages = inventory.reserve(lines)
+        if shortages:
+            # 在庫が足りない商品があれば注文せず、カートに戻して知らせる
+            session['stock_shortage'] = shortages
+            return redirect(url_for('cart'))
+        order = orders.new_order(priced, visitor_id=app.config['VISITOR_ID'])
+        try:
+            order_writer.submit(order)
+        except RuntimeError:
+            inventory.release(lines)
+            raise
+        order_id = order.id
 
     session.pop('cart', None)
     
     return render_template('complete.html', 
-                           order_items=order_items, 
-                           total_price=total_price, 
-                           currency_code=currency_code)
+                           order_id=order_id,
+                           order_items=priced.lines, 
+                           total_price=priced.total_price, 
+                           currency_code=priced.currency_code)
+
+@app.route('/_raw/<product_id>')
+def raw_product(product_id):
+    # デバッグ用: フィードの元レコードをそのまま返す
+    try:
+        raw = raw_products.get_raw_product(product_id)
+    except FileNotFoundError:
+        raw = None
+    if raw is None:
+        return "Product not found", 404
+    return bytes(raw), 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+@app.route('/_stats')
+def stats():
+    return jsonify(catalog=catalog.stats(),
+                   search_cache=search_cache.stats(),
+                   search_flight=search_flight.stats(),
+                   search_breaker=search_breaker.stats(),
+                   search_hedger=search_hedger.stats() if search_hedger else None,
+                   raw_products=raw_products.stats(),
+                   sessions=session_store.stats() if session_store else None,
+                   orders=order_writer.stats(),
+                   inventory=inventory.stats())
 
 @app.context_processor
 def inject_gtm():
@@ -0,0 +1,345 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import catalog
+import db
+import ingest
+import init_db
+import orders
+from collections import Counter
+from inventory import Inventory
+from cart_pricing import price_cart
+
+# 簡易ベンチマーク。gunicorn と同じくスレッドを並べて、1 リクエストあたりの
+# 処理時間を測る。例: python3 benchmark.py db --threads 8 --requests 2000
+
+DB_PATH = 'ecommerce.db'
+
+
+def run_threads(threads, requests, fn):
+    # fn(i) を threads 本のスレッドで合計 requests 回実行し、経過秒を返す
+    per_thread = max(1, requests // threads)
+    barrier = threading.Barrier(threads)
+
+    def worker():
+        barrier.wait()
+        for i in range(per_thread):
+            fn(i)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - start, per_thread * threads
+
+
+def report(name, elapsed, count):
+    print(f"{name:<40} {count / elapsed:>10.0f} req/s  {elapsed / count * 1e6:>8.1f} us/req")
+
+
+def bench_db(args):
+    # 実際のルートを test_client 経由で呼び、DB 接続の持ち方だけを変えて比べる。
+    # cart はスナップショットだけで描画するので DB には触れない(差が出ないのが正しい)
+    tmpdir = tempfile.mkdtemp()
+    os.environ.setdefault('SEARCH_BACKEND', 'local')
+    os.environ.setdefault('SESSION_BACKEND', 'memory')
+    os.environ.setdefault('ORDERS_DB', os.path.join(tmpdir, 'orders.db'))
+    os.environ.setdefault('INVENTORY_DB', os.path.join(tmpdir, 'inventory.db'))
+    import app as web
+
+    ids = list(web.catalog.snapshot().by_id)
+    local = threading.local()
+
+    def client():
+        c = getattr(local, 'client', None)
+        if c is None:
+            c = local.client = web.app.test_client()
+            rng = random.Random(threading.get_ident())
+            for pid in rng.sample(ids, args.cart_lines):
+                c.post('/api/cart/items', json={'product_id': pid, 'quantity': 1})
+        return c
+
+    # 変更前: リクエストごとに connect し、リクエストの終わりに閉じる
+    def per_request_db(readonly=True):
+        conn = db.connect(web.DB_PATH, readonly=readonly)
+        web.g.setdefault('bench_conns', []).append(conn)
+        return conn
+
+    @web.app.teardown_request
+    def close_bench_conns(exc):
+        for conn in web.g.pop('bench_conns', []):
+            conn.close()
+
+    routes = (
+        ('detail', lambda i: f'/product/{ids[i % len(ids)]}'),
+        ('home', lambda i: '/'),
+        ('cart', lambda i: '/cart'),
+    )
+    pooled_db = web.get_db
+    try:
+        for route, url in routes:
+            def get(i):
+                response = client().get(url(i))
+                assert response.status_code == 200, response.status_code
+
+            web.get_db = per_request_db
+            report(f'{route}: connect per request', *run_threads(args.threads, args.requests, get))
+            # 変更後: スレッドごとの接続を使い回す
+            web.get_db = pooled_db
+            report(f'{route}: per-thread connection', *run_threads(args.threads, args.requests, get))
+    finally:
+        web.get_db = pooled_db
+        shutil.rmtree(tmpdir)
+
+
+def scaled_db(path, factor):
+    # ecommerce.db の商品を factor 倍に複製したベンチマーク用 DB を作る
+    shutil.copy(DB_PATH, path)
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TEMP TABLE base AS SELECT * FROM products')
+    for k in range(1, factor):
+        conn.execute("INSERT INTO products (id, title, category, price, currency_code, image_url, availability, content_hash) "
+                     "SELECT id || '-' || ?, title, category, price, currency_code, image_url, availability, content_hash FROM base",
+                     (k,))
+    conn.commit()
+    conn.close()
+
+
+def bench_home(args):
+    # 一覧ページ: 全件描画(変更前)とキーセットで 1 ページ描画(変更後)を比較する
+    os.environ.setdefault('SEARCH_BACKEND', 'local')
+    from flask import render_template
+    import app as web
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for factor in args.scale:
+            path = os.path.join(tmpdir, f'scaled_{factor}.db')
+            scaled_db(path, factor)
+            snapshot = catalog.load_snapshot(path)
+            conn = db.connect(path)
+
+            def render(products, listing):
+                with web.app.test_request_context('/'):
+                    return render_template('index.html', products=products, query='',
+                                           attribution_token=None, page=1, has_next=False,
+                                           listing=listing, sort='category', offset=0,
+                                           filters=catalog.NO_FILTER, filter_args={},
+                                           categories=snapshot.categories,
+                                           visitor_id='bench')
+
+            def before():
+                rows = conn.execute('SELECT * FROM products').fetchall()
+                return render([dict(row) for row in rows], None)
+
+            def after():
+                listing = catalog.list_products(conn, limit=args.page_size)
+                return render([snapshot.get(pid) for pid in listing.product_ids], listing)
+
+            for name, fn in (('all products', before), (f'keyset page of {args.page_size}', after)):
+                size = len(fn().encode('utf-8'))
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    fn()
+                elapsed = (time.perf_counter() - start) / args.repeat
+                print(f"{len(snapshot):>8} products  {name:<24} {elapsed * 1e3:>9.2f} ms  {size / 1024:>9.1f} KiB")
+            conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def scaled_feed(path, lines):
+    # products_data.jsonl を id を変えながら繰り返して lines 行のフィードを作る
+    with open(init_db.DATA_FILE, encoding='utf-8') as f:
+        base = [json.loads(line) for line in f if line.strip()]
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(lines):
+            item = dict(base[i % len(base)])
+            item['id'] = f"{item['id']}-{i // len(base)}"
+            f.write(json.dumps(item, ensure_ascii=False) + '\n')
+
+
+def bench_ingest(args):
+    # フィードのパース(デコード〜正規化〜重複除去)をワーカー数を変えて測る。DB には書かない
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'feed.jsonl')
+        scaled_feed(path, args.lines)
+        size = os.path.getsize(path)
+        print(f"{args.lines} lines, {size / 1024 / 1024:.1f} MiB, {os.cpu_count()} CPUs")
+        baseline = None
+        for workers in args.workers:
+            feed = ingest.Feed(path)
+            if workers > 1:
+                pipeline = ingest.Pipeline(ingest.build_parallel_stages(feed, workers))
+                source = feed.chunks(args.chunk_size)
+            else:
+                pipeline = ingest.Pipeline(ingest.build_stages())
+                source = feed.lines()
+            start = time.perf_counter()
+            pipeline.run(source)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            count = pipeline.counters[-1].items
+            print(f"workers={workers:<3} {count:>9} products  {elapsed:>7.2f} s  "
+                  f"{args.lines / elapsed:>10.0f} lines/s  x{baseline / elapsed:.2f}")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def random_carts(snapshot, count, lines, seed=0):
+    rng = random.Random(seed)
+    ids = list(snapshot.by_id)
+    return [{pid: rng.randint(1, 3) for pid in rng.sample(ids, lines)} for _ in range(count)]
+
+
+def bench_checkout(args):
+    # チェックアウト(注文の保存)のスループット: 注文ごとに commit する場合と
+    # write-behind キューに入れてまとめて commit する場合を比べる
+    snapshot = catalog.load_snapshot(DB_PATH)
+    carts = [price_cart(cart, snapshot) for cart in random_carts(snapshot, 256, args.cart_lines)]
+    # 通貨の混ざったカートは注文にできないので除く
+    carts = [priced for priced in carts if not priced.mixed_currency]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'sync.db')
+        orders.connect(path).close()
+        local = threading.local()
+
+        def synchronous(i):
+            conn = getattr(local, 'conn', None)
+            if conn is None:
+                conn = local.conn = orders.connect(path)
+            orders.write_orders(conn, [orders.new_order(carts[i % len(carts)])])
+
+        report('checkout: commit per order', *run_threads(args.threads, args.requests, synchronous))
+
+        writer = orders.OrderWriter(os.path.join(tmpdir, 'queued.db'),
+                                    maxsize=args.queue_size, batch_size=args.batch_size)
+
+        def queued(i):
+            writer.submit(orders.new_order(carts[i % len(carts)]))
+
+        elapsed, count = run_threads(args.threads, args.requests, queued)
+        start = time.perf_counter()
+        writer.flush()
+        drain = time.perf_counter() - start
+        report('checkout: write-behind queue', elapsed, count)
+        report('checkout: write-behind incl. flush', elapsed + drain, count)
+        stats = writer.stats()
+        writer.close()
+        print(f"{stats['written']} orders in {stats['batches']} commits "
+              f"(max batch {stats['max_batch']}, submit blocked {stats['blocked']} times)")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_inventory(args):
+    # 在庫の引き当て: 全員が同じ人気商品を買う場合と、商品がばらける場合で
+    # スレッド数ぶん同時に購入確定したときのスループットと売り越しを測る
+    ids = list(catalog.load_snapshot(DB_PATH).by_id)
+    hot = ids[0]
+    stock = args.requests // 2   # 人気商品は途中で売り切れる
+
+    def read_then_write(conn, pid):
+        # 変更前に相当: 読んでから書く(同時に買われると売り越す)
+        row = conn.execute('SELECT stock FROM inventory WHERE product_id = ?', (pid,)).fetchone()
+        if row[0] < 1:
+            return False
+        conn.execute('UPDATE inventory SET stock = ? WHERE product_id = ?', (row[0] - 1, pid))
+        return True
+
+    def busy_wait(conn, pid):
+        # 条件付き UPDATE だけ(スレッド間の待ちは SQLite の busy_timeout 任せ)
+        conn.execute('BEGIN IMMEDIATE')
+        ok = conn.execute('UPDATE inventory SET stock = stock - 1 WHERE product_id = ? AND stock >= 1',
+                          (pid,)).rowcount == 1
+        conn.execute('COMMIT')
+        return ok
+
+    variants = (('read then write', read_then_write),
+                ('conditional UPDATE, busy wait', busy_wait),
+                ('Inventory.reserve', None))
+    scenarios = (('hot SKU', lambda i: hot), ('spread', lambda i: ids[i % len(ids)]))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for scenario, pick in scenarios:
+            for name, fn in variants:
+                path = os.path.join(tmpdir, f'{scenario}-{name}.db'.replace(' ', '_'))
+                inventory = Inventory(path)
+                inventory.set_stock({pid: stock for pid in ids})
+                local = threading.local()
+                sold = Counter()
+                lock = threading.Lock()
+
+                def checkout(i):
+                    pid = pick(i)
+                    if fn is None:
+                        ok = not inventory.reserve([(pid, 1)])
+                    else:
+                        conn = getattr(local, 'conn', None)
+                        if conn is None:
+                            conn = local.conn = db.connect(path, readonly=False)
+                            conn.isolation_level = None
+                            conn.execute('PRAGMA synchronous = NORMAL')
+                        ok = fn(conn, pid)
+                    if ok:
+                        with lock:
+                            sold[pid] += 1
+
+                elapsed, count = run_threads(args.threads, args.requests, checkout)
+                oversold = sum(max(0, n - stock) for n in sold.values())
+                report(f'{scenario}: {name}', elapsed, count)
+                print(f"{'':<40} sold {sum(sold.values())}, rejected {count - sum(sold.values())}, "
+                      f"oversold {oversold}")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EC site micro benchmarks')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=4000)
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('db', help='per-request vs per-thread SQLite connections')
+    p.add_argument('--cart-lines', type=int, default=5)
+    p.set_defaults(func=bench_db)
+
+    p = sub.add_parser('home', help='home page render time and size: full catalog vs keyset page')
+    p.add_argument('--scale', type=int, nargs='+', default=[1, 10, 50])
+    p.add_argument('--page-size', type=int, default=48)
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_home)
+
+    p = sub.add_parser('ingest', help='feed parse throughput by number of worker processes')
+    p.add_argument('--lines', type=int, default=500000)
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    p.add_argument('--chunk-size', type=int, default=4 * 1024 * 1024)
+    p.set_defaults(func=bench_ingest)
+
+    p = sub.add_parser('checkout', help='order persistence: commit per order vs write-behind group commits')
+    p.add_argument('--cart-lines', type=int, default=3)
+    p.add_argument('--queue-size', type=int, default=orders.QUEUE_SIZE)
+    p.add_argument('--batch-size', type=int, default=orders.BATCH_SIZE)
+    p.set_defaults(func=bench_checkout)
+
+    p = sub.add_parser('inventory', help='stock reservation under contention: hot SKU vs spread')
+    p.set_defaults(func=bench_inventory)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import logging
+from collections import namedtuple
+
+# カートの明細と金額の計算(cart / add_to_cart / complete で共通)。
+# カート内の商品はスナップショットから 1 回のまとめ引きで取り出し、小計・合計・通貨を
+# ここで 1 度だけ計算する。明細が何行あってもコストは辞書引きだけで、DB には問い合わせない。
+# カタログには USD と JPY の商品が混ざっているので、合計は通貨ごとに出す(totals)。
+# 通貨が 1 つならそれが total_price / currency_code。混ざっていれば mixed_currency になり、
+# total_price / currency_code は None(足し合わせた金額は意味を持たないので作らない)。
+
+logger = logging.getLogger(__name__)
+
+CartLine = namedtuple('CartLine', ['product', 'quantity', 'item_total'])
+
+
+class PricedCart(namedtuple('PricedCart', ['lines', 'totals', 'total_price', 'currency_code', 'missing_ids'])):
+    __slots__ = ()
+
+    @property
+    def mixed_currency(self):
+        return len(self.totals) > 1
+
+
+DEFAULT_CURRENCY = 'USD'
+
+
+def lookup_products(snapshot, product_ids):
+    # id -> Product(存在しない id は含めない)
+    by_id = snapshot.by_id
+    return {pid: by_id[pid] for pid in product_ids if pid in by_id}
+
+
+def price_cart(cart, snapshot):
+    # cart: {product_id: quantity}(セッションのカート)
+    quantities = [(pid, qty) for pid, qty in cart.items() if qty > 0]
+    products = lookup_products(snapshot, [pid for pid, _ in quantities])
+
+    lines = []
+    missing_ids = []
+    totals = {}   # currency_code -> 合計(明細に出てきた順)
+    for pid, qty in quantities:
+        product = products.get(pid)
+        if product is None:
+            # カタログから消えた商品は明細に出さない
+            missing_ids.append(pid)
+            continue
+        item_total = product.price * qty
+        totals[product.currency_code] = totals.get(product.currency_code, 0) + item_total
+        lines.append(CartLine(product=product, quantity=qty, item_total=item_total))
+
+    if len(totals) > 1:
+        logger.debug('Cart has mixed currencies %s', sorted(totals))
+        total_price = currency_code = None
+    elif totals:
+        (currency_code, total_price), = totals.items()
+    else:
+        total_price, currency_code = 0, DEFAULT_CURRENCY
+    return PricedCart(lines=lines, totals=totals, total_price=total_price, currency_code=currency_code,
+                      missing_ids=missing_ids)
@@ -0,0 +1,376 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# 商品カタログのインメモリスナップショット。
+# カタログは init_db.py / ingest.py の実行時にしか変わらないので、ワーカーごとに
+# 一度だけ読み込み、読み取り系のルートはすべてここから引く。
+# DB ファイルが更新されたら新しいスナップショットを作って差し替える
+# (読み取り側はロック不要で、古いスナップショットを使い終えるまで参照できる)。
+# 差分反映(product_changes に記録される)なら変わった商品だけを読み直す。
+# init_db.py --rebuild で作り直された DB は世代 ID(catalog_generation)が変わるので、
+# 変更履歴を使わずに丸ごと読み直す(作り直しで履歴の seq が振り直されるため)。
+
+PRODUCT_COLUMNS = ('id', 'title', 'category', 'price', 'currency_code', 'image_url', 'availability')
+
+
+class Product:
+    __slots__ = PRODUCT_COLUMNS
+
+    def __init__(self, id, title, category, price, currency_code, image_url, availability):
+        self.id = id
+        self.title = title
+        self.category = category
+        self.price = price
+        self.currency_code = currency_code
+        self.image_url = image_url
+        self.availability = availability
+
+    # sqlite3.Row と同じく product['title'] / dict(product) で扱えるようにする
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def keys(self):
+        return self.__slots__
+
+    def __repr__(self):
+        return f'Product({self.id!r})'
+
+
+class CatalogSnapshot:
+    __slots__ = ('by_id', 'categories', 'version', 'change_seq', 'generation', 'loaded_at')
+
+    def __init__(self, by_id, categories, version, change_seq=0, generation=None):
+        self.by_id = by_id
+        # name -> 商品数 (init_db.py で集計済み)
+        self.categories = dict(categories)
+        self.version = version
+        # どこまでの変更履歴 (product_changes.seq) を反映済みか
+        self.change_seq = change_seq
+        # 読み込んだ DB の世代(init_db.build_db ごとに変わる)
+        self.generation = generation
+        self.loaded_at = time.time()
+
+    @property
+    def products(self):
+        return tuple(self.by_id.values())
+
+    def get(self, product_id):
+        return self.by_id.get(product_id)
+
+    def updated(self, products, deleted_ids, categories, version, change_seq):
+        # 変わった商品だけを入れ替えた新しいスナップショット。自分自身は変更しないので
+        # 古いスナップショットを使っている読み取り側に影響しない
+        if not products and not deleted_ids:
+            return CatalogSnapshot(self.by_id, categories, version, change_seq, self.generation)
+        by_id = dict(self.by_id)
+        for product_id in deleted_ids:
+            by_id.pop(product_id, None)
+        for product in products:
+            by_id[product.id] = product
+        return CatalogSnapshot(by_id, categories, version, change_seq, self.generation)
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+def db_version(db_path):
+    # WAL モードでは書き込みが -wal ファイルに入るので、両方の stat を見る
+    version = []
+    for path in (db_path, db_path + '-wal'):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            version.append(None)
+            continue
+        version.append((st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(version)
+
+
+def _connect_ro(db_path):
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    # 複数の SELECT を同じ時点の状態で読む
+    conn.execute('BEGIN')
+    return conn
+
+
+def _read_categories(conn):
+    return conn.execute('SELECT name, product_count FROM categories ORDER BY name').fetchall()
+
+
+def _read_change_seq(conn):
+    return conn.execute('SELECT COALESCE(MAX(seq), 0) FROM product_changes').fetchone()[0]
+
+
+def _read_generation(conn):
+    try:
+        row = conn.execute('SELECT id FROM catalog_generation').fetchone()
+    except sqlite3.OperationalError:
+        # 世代 ID を持たない古いスキーマの DB
+        return None
+    return row[0] if row else None
+
+
+def load_snapshot(db_path):
+    version = db_version(db_path)
+    conn = _connect_ro(db_path)
+    try:
+        rows = conn.execute(f'SELECT {", ".join(PRODUCT_COLUMNS)} FROM products').fetchall()
+        categories = _read_categories(conn)
+        change_seq = _read_change_seq(conn)
+        generation = _read_generation(conn)
+    finally:
+        conn.close()
+    return CatalogSnapshot({row[0]: Product(*row) for row in rows}, categories, version, change_seq, generation)
+
+
+# 変更がこれより多ければ差分ではなく丸ごと読み直す
+INCREMENTAL_LIMIT = 10000
+
+
+def load_changes(db_path, snapshot):
+    # snapshot 以降の変更履歴を読み、変わった商品だけを入れ替えたスナップショットと
+    # 変わった id の集合を返す。履歴が足りない・多すぎる場合は None(丸ごと読み直す)
+    version = db_version(db_path)
+    if version[0] is None or snapshot.version[0] is None or version[0][0] != snapshot.version[0][0]:
+        # DB ファイル自体が別のファイルになった
+        return None
+    conn = _connect_ro(db_path)
+    try:
+        if _read_generation(conn) != snapshot.generation:
+            # init_db.py --rebuild で作り直された。seq は新しい DB で振り直されているので比べられない
+            return None
+        oldest = conn.execute('SELECT MIN(seq) FROM product_changes').fetchone()[0]
+        if oldest is not None and oldest > snapshot.change_seq + 1:
+            # 履歴が足りない(古い分が消えた)
+            return None
+        rows = conn.execute('SELECT seq, product_id FROM product_changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                            (snapshot.change_seq, INCREMENTAL_LIMIT + 1)).fetchall()
+        if len(rows) > INCREMENTAL_LIMIT:
+            return None
+        change_seq = rows[-1][0] if rows else snapshot.change_seq
+        changed_ids = {product_id for _, product_id in rows}
+        products = []
+        ids = list(changed_ids)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            products.extend(Product(*row) for row in conn.execute(
+                f'SELECT {", ".join(PRODUCT_COLUMNS)} FROM products WHERE id IN ({", ".join("?" * len(chunk))})',
+                chunk))
+        categories = _read_categories(conn)
+    finally:
+        conn.close()
+    deleted_ids = changed_ids - {p.id for p in products}
+    return snapshot.updated(products, deleted_ids, categories, version, change_seq), changed_ids
+
+
+class Catalog:
+    def __init__(self, db_path, check_interval=1.0):
+        self.db_path = db_path
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.reloads = 0
+        self.incremental_reloads = 0
+
+    def on_change(self, fn):
+        # 差分で商品が入れ替わったときに fn(変わった id の集合) を呼ぶ(キャッシュの部分破棄用)
+        self._listeners.append(fn)
+        return fn
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self._checked_at < self.check_interval:
+            return snapshot
+        # 更新チェックは 1 スレッドだけが行い、他のスレッドは今のスナップショットを使う
+        if not self._lock.acquire(blocking=snapshot is None):
+            return snapshot
+        try:
+            snapshot = self._snapshot
+            self._checked_at = now
+            if snapshot is None or db_version(self.db_path) != snapshot.version:
+                try:
+                    self._reload(snapshot)
+                except sqlite3.Error as e:
+                    # init_db.py の再構築中などで読めない場合は古いスナップショットを使い続ける
+                    if snapshot is None:
+                        raise
+                    print(f"Catalog reload failed, keeping previous snapshot: {e}")
+            return self._snapshot
+        finally:
+            self._lock.release()
+
+    def _reload(self, snapshot):
+        # 差分フィードなどで一部の商品だけが変わった場合はその商品だけを読み直す
+        changes = load_changes(self.db_path, snapshot) if snapshot is not None else None
+        if changes is None:
+            self._snapshot = load_snapshot(self.db_path)
+            self.reloads += 1
+            print(f"Loaded catalog snapshot: {len(self._snapshot)} products")
+            return
+        self._snapshot, changed_ids = changes
+        if not changed_ids:
+            return
+        self.incremental_reloads += 1
+        for fn in self._listeners:
+            try:
+                fn(changed_ids)
+            except Exception as e:
+                print(f"Catalog change listener failed: {e!r}")
+
+    def get(self, product_id):
+        return self.snapshot().get(product_id)
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            'products': len(snapshot) if snapshot else 0,
+            'reloads': self.reloads,
+            'incremental_reloads': self.incremental_reloads,
+            'change_seq': snapshot.change_seq if snapshot else None,
+            'generation': snapshot.generation if snapshot else None,
+            'loaded_at': snapshot.loaded_at if snapshot else None,
+        }
+
+
+# --- 詳細ページ用の属性 ---
+# タグ・全画像・商品ページ URL などはスナップショットに載せず、詳細ページで
+# product_details を主キーで 1 回引く。
+
+ProductDetails = namedtuple('ProductDetails', ['primary_product_id', 'uri', 'tags', 'images', 'attributes'])
+
+
+def load_details(conn, product_id):
+    row = conn.execute('SELECT primary_product_id, uri, tags, images, attributes '
+                       'FROM product_details WHERE product_id = ?', (product_id,)).fetchone()
+    if row is None:
+        return None
+    primary_product_id, uri, tags, images, attributes = row
+    return ProductDetails(primary_product_id=primary_product_id,
+                          uri=uri,
+                          tags=json.loads(tags),
+                          images=json.loads(images),
+                          attributes=json.loads(attributes) if attributes else {})
+
+
+# --- トップページの一覧(キーセットページネーション) ---
+# OFFSET を使わず「前ページ最後の行のソートキーより後」を索引の範囲スキャンで取るので、
+# 何ページ目でもコストが一定。ソートキーは必ず id で終わるので順序が一意に決まる。
+# (category, id) / (price, id) の索引はキーだけを返すカバリング索引として使い、
+# 行の中身はスナップショットから引く。
+# カテゴリ別一覧は product_categories の (category, ...) 範囲スキャンになる。
+
+LISTING_SORTS = {
+    # name: (sort columns, descending)
+    'category': (('category', 'id'), False),
+    'price_asc': (('price', 'id'), False),
+    'price_desc': (('price', 'id'), True),
+}
+
+CATEGORY_LISTING_SORTS = {
+    'category': (('product_id',), False),
+    'price_asc': (('price', 'product_id'), False),
+    'price_desc': (('price', 'product_id'), True),
+}
+
+ListingPage = namedtuple('ListingPage', ['product_ids', 'next_cursor', 'prev_cursor'])
+
+# 一覧・検索共通の絞り込み条件。None の項目は絞り込まない
+ProductFilter = namedtuple('ProductFilter', ['min_price', 'max_price', 'availability'])
+NO_FILTER = ProductFilter(None, None, None)
+
+
+def filter_clauses(filters, price_column='price', availability_column='availability'):
+    where = []
+    params = []
+    if filters.min_price is not None:
+        where.append(f'{price_column} >= ?')
+        params.append(filters.min_price)
+    if filters.max_price is not None:
+        where.append(f'{price_column} <= ?')
+        params.append(filters.max_price)
+    if filters.availability:
+        where.append(f'{availability_column} = ?')
+        params.append(filters.availability)
+    return where, params
+
+
+def encode_cursor(key):
+    raw = json.dumps(list(key), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    # 壊れた/古いカーソルは先頭ページ扱いにする
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        key = json.loads(raw.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(key, list) or len(key) != length:
+        return None
+    return tuple(key)
+
+
+def list_products(conn, sort='category', after=None, before=None, limit=48, category=None,
+                  filters=NO_FILTER):
+    if category is None:
+        table, sorts = 'products', LISTING_SORTS
+    else:
+        table, sorts = 'product_categories', CATEGORY_LISTING_SORTS
+    columns, descending = sorts.get(sort, sorts['category'])
+    cursor = decode_cursor(before, len(columns))
+    forward = cursor is None
+    if forward:
+        cursor = decode_cursor(after, len(columns))
+    # 「前へ」は逆向きにスキャンして、取得後に並びを戻す
+    ascending = forward != descending
+
+    # 価格以外で並べるときは価格帯で索引を選ばせない(+price)。並び順の索引を
+    # 先頭から読み、索引内で価格を判定して limit 件で止まる方が速い
+    price_column = 'price' if 'price' in columns else '+price'
+    where, params = filter_clauses(filters, price_column=price_column)
+    if category is not None:
+        where.insert(0, 'category = ?')
+        params.insert(0, category)
+    if cursor is not None:
+        op = '>' if ascending else '<'
+        placeholders = ', '.join('?' * len(columns))
+        where.append(f'({", ".join(columns)}) {op} ({placeholders})')
+        params.extend(cursor)
+    sql = f'SELECT {", ".join(columns)} FROM {table}'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    direction = 'ASC' if ascending else 'DESC'
+    sql += ' ORDER BY ' + ', '.join(f'{c} {direction}' for c in columns) + ' LIMIT ?'
+    # 次(前)のページがあるかを知るため 1 件多く取る
+    params.append(limit + 1)
+
+    rows = [tuple(row) for row in conn.execute(sql, params).fetchall()]
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not forward:
+        rows.reverse()
+    if not rows:
+        return ListingPage(product_ids=(), next_cursor=None, prev_cursor=None)
+
+    if forward:
+        has_next, has_prev = more, cursor is not None
+    else:
+        has_next, has_prev = cursor is not None, more
+    return ListingPage(
+        product_ids=tuple(row[-1] for row in rows),
+        next_cursor=encode_cursor(rows[-1]) if has_next else None,
+        prev_cursor=encode_cursor(rows[0]) if has_prev else None)
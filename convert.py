@@ -1,4 +1,4 @@
-import json
+import ingest
 
 # 設定
 input_file = 'products_data.jsonl'
@@ -6,22 +6,13 @@ output_file = 'products_data_utf8.jsonl'
 
 def convert_jsonl_to_utf8(input_path, output_path):
     print(f"変換を開始します: {input_path} -> {output_path}")
-    
-    with open(input_path, 'r', encoding='utf-8') as f_in, \
-         open(output_path, 'w', encoding='utf-8') as f_out:
-        
-        for line in f_in:
-            if not line.strip():
-                continue
-            
-            # json.loads() は \uXXXX 形式を自動的にUnicode文字列に変換します
-            data = json.loads(line)
-            
-            # ensure_ascii=False を指定することで、日本語をそのまま(UTF-8)出力します
-            json.dump(data, f_out, ensure_ascii=False)
-            f_out.write('\n')
+
+    # json.loads() は \uXXXX 形式を自動的にUnicode文字列に変換し、
+    # ensure_ascii=False で日本語をそのまま(UTF-8)出力します
+    # (DB まで一度に取り込む場合は ingest.py を使ってください)
+    ingest.Pipeline(ingest.build_stages(jsonl_out=output_path, to_db=False)).run(ingest.read_lines(input_path))
 
     print("変換が完了しました。")
 
 if __name__ == "__main__":
-    convert_jsonl_to_utf8(input_file, output_file)
\ No newline at end of file
+    convert_jsonl_to_utf8(input_file, output_file)
@@ -0,0 +1,51 @@
+import sqlite3
+import threading
+
+# スレッドごとに使い回す SQLite 接続。
+# gunicorn の --threads で動くワーカースレッドは長生きなので、リクエストごとに
+# connect/close せず、スレッドローカルに接続を持ち続ける。
+# init_db.py --rebuild は SQLite のバックアップ API で同じファイルに書き込む(ファイルは
+# 差し替えない)ので、開いたままの接続も次のトランザクションから新しい内容を読む。
+
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = (
+    'PRAGMA mmap_size = 268435456',   # 256 MiB
+    'PRAGMA cache_size = -16000',     # 16 MiB
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+)
+
+_local = threading.local()
+
+
+def connect(db_path, readonly=True):
+    if readonly:
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+    else:
+        conn = sqlite3.connect(db_path, cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    if readonly:
+        conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+def get_connection(db_path, readonly=True):
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    key = (db_path, readonly)
+    conn = conns.get(key)
+    if conn is None:
+        conn = conns[key] = connect(db_path, readonly)
+    return conn
+
+
+def close_thread_connections():
+    conns = getattr(_local, 'conns', None) or {}
+    for conn in conns.values():
+        conn.close()
+    conns.clear()
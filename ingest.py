@@ -0,0 +1,536 @@
+import argparse
+import bz2
+import functools
+import gzip
+import io
+import json
+import math
+import lzma
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import init_db
+import raw_index
+
+# 商品フィード(JSONL)の取り込みパイプライン。
+# 以前は convert.py / update_data.py / init_db.py がそれぞれ JSONL 全体をデコードして
+# 中間ファイルに書き直していたが、ここでは 1 行ずつジェネレータで流して 1 パスで処理する。
+#
+#   read -> decode -> [rewrite_images] -> [write_jsonl] -> normalize -> dedup -> DB
+#
+# 各段は「iterable を受け取って iterable を返す」関数なので、段の追加・入れ替えは
+# stages のリストをいじるだけでよい。メモリに持つのは重複除去用の id の集合と
+# DB 書き込みの 1 バッチ分だけ。
+# 例: python3 ingest.py products_data.jsonl --rewrite-images --db ecommerce.db
+#
+# フィードは gzip / bz2 / xz 圧縮のままでも読める。再構築(--rebuild)は読み終えた
+# バイト位置を一時 DB に記録しながら進むので、中断しても次の実行で続きから再開する。
+# 価格・在庫などの差分は --delta FILE [--follow] で追記型の差分フィードから反映する。
+#
+# --workers N (N > 1) ではデコード〜正規化をプロセスプールで並列に行う。ファイルを
+# 改行位置に揃えたバイト範囲のチャンクに分けて各プロセスで処理し、結果はチャンクの
+# 順に受け取るので、重複除去(最初に出てきた id を使う)の結果は 1 プロセスの時と同じ。
+
+IMAGE_URI_TEMPLATE = 'https://ik.imagekit.io/RM/store/20160512512/assets/items/largeimages/{id}.jpg'
+
+
+class StageCounter:
+    # 段ごとの件数と経過時間。seconds は上流の段の時間を含む(next() を待った時間)
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.seconds = 0.0
+
+    def wrap(self, iterable):
+        it = iter(iterable)
+        clock = time.perf_counter
+        while True:
+            start = clock()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.seconds += clock() - start
+                return
+            self.seconds += clock() - start
+            self.items += 1
+            yield item
+
+
+class Pipeline:
+    def __init__(self, stages):
+        # stages: [(name, fn)] で fn(iterable) -> iterable
+        self.stages = list(stages)
+        self.counters = []
+        self.elapsed = 0.0
+
+    def run(self, source, sink=None):
+        # source は入力行などの iterable。読み込みも 'read' 段として数える
+        read = StageCounter('read')
+        self.counters = [read]
+        stream = read.wrap(source)
+        for name, fn in self.stages:
+            counter = StageCounter(name)
+            self.counters.append(counter)
+            stream = counter.wrap(fn(stream))
+        start = time.perf_counter()
+        if sink is None:
+            # 出力はパススルーの段(write_jsonl など)に任せて流し切るだけ
+            for _ in stream:
+                pass
+        else:
+            sink(stream)
+        self.elapsed = time.perf_counter() - start
+        return self
+
+    def report(self):
+        # 各段の正味の時間 = その段の時間 - 上流の段の時間
+        print(f"{'stage':<16} {'items':>10} {'seconds':>9} {'items/s':>12}")
+        upstream = 0.0
+        rows = [(c.name, c.items, c.seconds) for c in self.counters]
+        rows.append(('write', self.counters[-1].items, self.elapsed))
+        for name, items, seconds in rows:
+            own = max(seconds - upstream, 0.0)
+            upstream = seconds
+            rate = f'{items / own:>12.0f}' if own > 0 else f"{'-':>12}"
+            print(f"{name:<16} {items:>10} {own:>9.3f} {rate}")
+        print(f"{'total':<16} {'':>10} {self.elapsed:>9.3f}")
+
+
+# --- 入力 ---
+
+# 圧縮形式は拡張子ではなく先頭のマジックバイトで判定する
+COMPRESSED_FORMATS = (
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+)
+
+
+def open_feed(path):
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+    for prefix, opener in COMPRESSED_FORMATS:
+        if magic.startswith(prefix):
+            return opener(path, 'rb')
+    return open(path, 'rb')
+
+
+class Feed:
+    # 入力フィード。offset は読み終えた位置(圧縮ファイルなら展開後のバイト位置)で、
+    # 再構築のチェックポイントに記録される
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.offset = offset
+        self.line_start = offset
+        with open_feed(path) as f:
+            self.compressed = not isinstance(f, io.BufferedReader)
+
+    def fingerprint(self):
+        # フィードが差し替えられていたらチェックポイントは使わない
+        st = os.stat(self.path)
+        return f'{os.path.abspath(self.path)}:{st.st_size}:{st.st_mtime_ns}'
+
+    def lines(self):
+        with open_feed(self.path) as f:
+            if self.offset:
+                # 圧縮ファイルの seek は先頭から展開して読み飛ばす(パースや DB 書き込みよりは安い)
+                f.seek(self.offset)
+            for line in f:
+                # line_start/offset はいま流している行の範囲(生レコード索引用)
+                self.line_start = self.offset
+                self.offset += len(line)
+                if line.strip():
+                    yield line
+
+    def chunks(self, chunk_size):
+        # 並列パース用に (start, end, data) を返す。非圧縮ならワーカーが直接ファイルを
+        # 読むので data は None、圧縮ファイルは展開したバイト列を渡す。境界は必ず行頭
+        if not self.compressed:
+            size = os.path.getsize(self.path)
+            with open(self.path, 'rb') as f:
+                start = self.offset
+                while start < size:
+                    f.seek(min(start + chunk_size, size))
+                    f.readline()
+                    end = min(f.tell(), size)
+                    yield start, end, None
+                    start = end
+            return
+        with open_feed(self.path) as f:
+            start = self.offset
+            if start:
+                f.seek(start)
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                data += f.readline()
+                yield start, start + len(data), data
+                start += len(data)
+
+
+def read_lines(path):
+    return Feed(path).lines()
+
+
+# --- 段 ---
+
+def decode(lines):
+    for line in lines:
+        try:
+            yield json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            print(f"Skipping invalid JSON line: {line[:50]}...")
+
+
+def rewrite_images(items, template=IMAGE_URI_TEMPLATE):
+    # 先頭画像の URI を商品 ID から組み立てた URL に差し替える(旧 update_data.py)
+    for item in items:
+        new_image_url = template.format(id=item.get('id'))
+        if item.get('images'):
+            item['images'][0]['uri'] = new_image_url
+        else:
+            item['images'] = [{'uri': new_image_url}]
+        yield item
+
+
+def write_jsonl(path, ensure_ascii=False):
+    # 流れてきたレコードをそのまま書き出して次の段へ渡す(旧 convert.py / update_data.py)
+    def stage(items):
+        with open(path, 'w', encoding='utf-8') as f:
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=ensure_ascii))
+                f.write('\n')
+                yield item
+    return stage
+
+
+def index_lines(feed, builder):
+    # decode の直後に置き、各レコードの id と元の行の位置を生レコード索引に記録する。
+    # 段は 1 件ずつ引くので、レコードが流れてきた時点の feed.line_start がその行の位置
+    def stage(items):
+        for item in items:
+            builder.add(item.get('id'), feed.line_start, feed.offset - feed.line_start)
+            yield item
+    return stage
+
+
+def normalize(items):
+    for item in items:
+        try:
+            yield init_db.parse_product(item)
+        except Exception as e:
+            print(f"Error processing line: {e}")
+
+
+def dedup(products, seen_ids=None):
+    # 同じ id が複数回出てきたら最初のものを使う。
+    # 中断した再構築を再開するときは取り込み済みの id を seen_ids に渡す
+    seen_ids = set() if seen_ids is None else seen_ids
+    for product in products:
+        if product['id'] in seen_ids:
+            continue
+        seen_ids.add(product['id'])
+        yield product
+
+
+# --- 並列パース ---
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class _ChunkLines:
+    # チャンク内の行を流しつつ、いまの行の位置を Feed と同じ属性で持つ
+    def __init__(self, data, start):
+        self.data = data
+        self.line_start = self.offset = start
+
+    def __iter__(self):
+        # splitlines() は U+2028 などでも分割してしまうので改行 (\n) だけで分ける
+        for line in self.data.split(b'\n'):
+            self.line_start = self.offset
+            self.offset += len(line) + 1
+            if line.strip():
+                yield line
+
+
+def _parse_chunk(path, start, end, data, rewrite, jsonl, ascii_out, to_db, index=False):
+    # ワーカープロセス側: 1 チャンク分をデコード〜重複除去まで済ませて返す
+    if data is None:
+        with open(path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+    lines = _ChunkLines(data, start)
+    items = decode(lines)
+    builder = raw_index.IndexBuilder(None) if index else None
+    if builder is not None:
+        items = index_lines(lines, builder)(items)
+    if rewrite:
+        items = rewrite_images(items)
+    items = list(items)
+    text = ''.join(json.dumps(item, ensure_ascii=ascii_out) + '\n' for item in items) if jsonl else None
+    spans = (builder.hashes, builder.offsets, builder.lengths) if builder is not None else None
+    if not to_db:
+        return text, items, spans
+    return text, list(dedup(normalize(items))), spans
+
+
+def parallel_parse(feed, workers, rewrite=False, jsonl_out=None, ascii_out=False, to_db=True, index=None):
+    # Feed.chunks() の出力を受け取り、正規化済みの商品をファイル順に流す段。
+    # 先読みするチャンクは workers * 2 個までなのでメモリは件数に比例しない。
+    # feed.offset は「流し終えたチャンクの終わり」までしか進めない(再開時は
+    # 途中まで取り込んだチャンクを読み直し、取り込み済みの id は dedup で飛ばす)
+    def emit(future, start, end, out):
+        text, products, spans = future.result()
+        if out is not None:
+            out.write(text)
+        if index is not None:
+            index.hashes.extend(spans[0])
+            index.offsets.extend(spans[1])
+            index.lengths.extend(spans[2])
+        feed.offset = start
+        yield from products
+        feed.offset = end
+
+    def stage(chunks):
+        out = open(jsonl_out, 'w', encoding='utf-8') if jsonl_out else None
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+                for start, end, data in chunks:
+                    future = pool.submit(_parse_chunk, feed.path, start, end, data,
+                                         rewrite, out is not None, ascii_out, to_db, index is not None)
+                    pending.append((future, start, end))
+                    if len(pending) >= workers * 2:
+                        yield from emit(*pending.popleft(), out)
+                while pending:
+                    yield from emit(*pending.popleft(), out)
+        finally:
+            if out is not None:
+                out.close()
+    return stage
+
+
+def build_stages(rewrite=False, jsonl_out=None, ascii_out=False, to_db=True, seen_ids=None,
+                 feed=None, index=None):
+    stages = [('decode', decode)]
+    if index is not None:
+        stages.append(('index', index_lines(feed, index)))
+    if rewrite:
+        stages.append(('rewrite_images', rewrite_images))
+    if jsonl_out:
+        stages.append(('write_jsonl', write_jsonl(jsonl_out, ensure_ascii=ascii_out)))
+    if to_db:
+        stages.append(('normalize', normalize))
+        stages.append(('dedup', functools.partial(dedup, seen_ids=seen_ids)))
+    return stages
+
+
+def build_parallel_stages(feed, workers, rewrite=False, jsonl_out=None, ascii_out=False, to_db=True,
+                          seen_ids=None, index=None):
+    stages = [('parse', parallel_parse(feed, workers, rewrite, jsonl_out, ascii_out, to_db, index))]
+    if to_db:
+        # チャンク内の重複はワーカーで除いてあるが、チャンクをまたぐ重複はここで除く
+        stages.append(('dedup', functools.partial(dedup, seen_ids=seen_ids)))
+    return stages
+
+
+def run(data_file=init_db.DATA_FILE, db_path=init_db.DB_PATH, rebuild=False, rewrite=False,
+        jsonl_out=None, ascii_out=False, batch_size=init_db.BATCH_SIZE, workers=1,
+        chunk_size=CHUNK_SIZE, resume=True, report=True):
+    feed = Feed(data_file)
+    to_db = db_path is not None
+    rebuild = to_db and (rebuild or init_db.needs_rebuild(db_path))
+    seen_ids = None
+    # 中断した再構築の続きから始める。JSONL を書き出す場合は途中からだと欠けるので最初から。
+    # 差分の同期(sync_db)は 1 トランザクションなので再開はなく、中断したら最初からやり直す
+    if rebuild and resume and not jsonl_out:
+        checkpoint = init_db.load_checkpoint(db_path, feed.fingerprint())
+        if checkpoint is not None:
+            feed.offset, seen_ids = checkpoint
+            print(f"Resuming {data_file} from byte {feed.offset} ({len(seen_ids)} products loaded)")
+
+    # 生レコード索引 (raw_index.py) も同じパスで作る。mmap で引くので非圧縮のフィードを
+    # 先頭から読む場合だけ(それ以外はアプリが初回に作り直す)
+    index = None
+    if to_db and not feed.compressed and feed.offset == 0:
+        index = raw_index.IndexBuilder(raw_index.feed_fingerprint(data_file))
+
+    if workers > 1:
+        pipeline = Pipeline(build_parallel_stages(feed, workers, rewrite, jsonl_out, ascii_out, to_db, seen_ids,
+                                                  index))
+        source = feed.chunks(chunk_size)
+    else:
+        pipeline = Pipeline(build_stages(rewrite, jsonl_out, ascii_out, to_db, seen_ids, feed, index))
+        source = feed.lines()
+
+    if rebuild:
+        sink = functools.partial(init_db.build_db, db_path, batch_size=batch_size,
+                                 checkpoint=(feed.fingerprint(), lambda: feed.offset),
+                                 resume=seen_ids is not None)
+    elif to_db:
+        sink = functools.partial(init_db.sync_db, db_path, batch_size=batch_size)
+    else:
+        sink = None
+    pipeline.run(source, sink)
+    if index is not None:
+        index.write(raw_index.index_path_for(db_path), data_file)
+    if report:
+        pipeline.report()
+    return pipeline
+
+
+# --- 差分フィード ---
+# 追記のみの JSONL。1 行が商品 1 件の upsert(フィードと同じ形式)か、
+# {"op": "delete", "id": "..."} の削除。価格・在庫の変更を数秒で店頭に反映するためのもので、
+# 小さなトランザクションで反映し、変更履歴(product_changes)を通じてアプリの
+# ワーカーに該当商品だけを読み直させる。
+# 既存の商品への upsert は部分更新でよい({"id": "...", "priceInfo": {"price": 1}} など)。
+# 書かれていない項目は DB に入っている値のまま残る(init_db.apply_delta で重ねる)。
+# 形の合わない行はログに出して読み飛ばす(反映位置は進めるので、同じ行で止まり続けない)
+
+DELTA_POLL_INTERVAL = 0.5
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def delta_error(item):
+    # 差分の 1 行を検査する。問題があればその説明、なければ None
+    if not isinstance(item, dict):
+        return 'not a JSON object'
+    op = item.get('op', 'upsert')
+    if op not in ('upsert', 'delete'):
+        return f'unknown op {op!r}'
+    if not isinstance(item.get('id'), str) or not item['id']:
+        return 'id must be a non-empty string'
+    if op == 'delete':
+        return None
+    if 'title' in item and (not isinstance(item['title'], str) or not item['title'].strip()):
+        return 'title must be a non-empty string'
+    if 'categories' in item and (not isinstance(item['categories'], list)
+                                 or not all(isinstance(c, str) for c in item['categories'])):
+        return 'categories must be a list of strings'
+    if 'priceInfo' in item:
+        price_info = item['priceInfo']
+        if not isinstance(price_info, dict):
+            return 'priceInfo must be an object'
+        if 'price' in price_info and not _is_number(price_info['price']):
+            return 'priceInfo.price must be a finite number'
+        if 'currencyCode' in price_info and not isinstance(price_info['currencyCode'], str):
+            return 'priceInfo.currencyCode must be a string'
+    if 'images' in item and (not isinstance(item['images'], list)
+                             or not all(isinstance(i, dict) for i in item['images'])):
+        return 'images must be a list of objects'
+    if 'tags' in item and not isinstance(item['tags'], list):
+        return 'tags must be a list'
+    if 'availability' in item and not isinstance(item['availability'], str):
+        return 'availability must be a string'
+    return None
+
+
+def parse_delta(items, rewrite=False):
+    # 差分の行を [('upsert', 元レコード(部分でもよい)) / ('delete', id)] にする
+    for item in items:
+        error = delta_error(item)
+        if error:
+            print(f"Skipping delta line ({error}): {json.dumps(item, ensure_ascii=False)[:80]}")
+            continue
+        if item.pop('op', 'upsert') == 'delete':
+            yield 'delete', item['id']
+            continue
+        if rewrite and 'images' in item:
+            # 部分 upsert は DB の商品に重ねるので、images の無い行に画像を足すと
+            # 保存済みの画像をすべて置き換えてしまう。images がある行だけ書き換える
+            item = next(rewrite_images([item]))
+        yield 'upsert', item
+
+
+def read_complete_lines(path, offset, limit):
+    # offset から改行で終わっている行を最大 limit 行読む。書きかけの最終行は次回に回す
+    lines = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while len(lines) < limit:
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            if line.strip():
+                lines.append(line)
+    return lines, offset
+
+
+def apply_deltas(delta_file, db_path=init_db.DB_PATH, batch_size=100, rewrite=False, follow=False,
+                 interval=DELTA_POLL_INTERVAL):
+    feed = os.path.abspath(delta_file)
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA busy_timeout = 5000')
+    try:
+        while True:
+            # 反映位置は毎回 DB から読む。init_db.py --rebuild で中身が作り直されたら
+            # 新しい DB の位置(最初から)を使う
+            offset = init_db.delta_offset(conn, feed)
+            if os.path.getsize(delta_file) < offset:
+                print(f"{delta_file} was truncated; reading it from the start")
+                offset = 0
+                init_db.apply_delta(conn, [], feed, offset)
+            lines, end = read_complete_lines(delta_file, offset, batch_size)
+            if end == offset:
+                if not follow:
+                    break
+                time.sleep(interval)
+                continue
+            ops = list(parse_delta(decode(lines), rewrite))
+            start = time.perf_counter()
+            inserted, updated, deleted = init_db.apply_delta(conn, ops, feed, end)
+            offset = end
+            if inserted or updated or deleted:
+                print(f"Applied {len(lines)} delta lines up to byte {offset}: {inserted} inserted, "
+                      f"{updated} updated, {deleted} deleted ({(time.perf_counter() - start) * 1e3:.1f} ms)")
+    finally:
+        conn.close()
+    return offset
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream the product feed through the ingest pipeline.')
+    parser.add_argument('data_file', nargs='?', default=init_db.DATA_FILE,
+                        help='JSONL feed, optionally gzip/bz2/xz compressed')
+    parser.add_argument('--db', default=init_db.DB_PATH, help='SQLite catalog to write')
+    parser.add_argument('--no-db', action='store_true', help='skip normalization and the database write')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='build a fresh database and atomically replace the current one')
+    parser.add_argument('--rewrite-images', action='store_true',
+                        help='point the first image of each product at the image CDN')
+    parser.add_argument('--jsonl-out', help='also write the (rewritten) records to this JSONL file')
+    parser.add_argument('--ascii', action='store_true', help='escape non-ASCII characters in --jsonl-out')
+    parser.add_argument('--batch-size', type=int, default=init_db.BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='parse the feed in this many processes (0: one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='bytes per chunk handed to a worker process')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='ignore the checkpoint of an interrupted rebuild and start over. '
+                             'Only --rebuild (or a schema upgrade) is checkpointed and resumable; '
+                             'the default sync runs in one transaction, so an interrupted sync '
+                             'leaves the database unchanged and is simply run again from the start')
+    parser.add_argument('--delta', metavar='FILE',
+                        help='apply an append-only delta JSONL (upserts and {"op": "delete"} lines) instead')
+    parser.add_argument('--follow', action='store_true', help='with --delta: keep tailing the file')
+    args = parser.parse_args()
+    if args.delta:
+        apply_deltas(args.delta, args.db, rewrite=args.rewrite_images, follow=args.follow)
+        return
+    run(args.data_file, db_path=None if args.no_db else args.db, rebuild=args.rebuild,
+        rewrite=args.rewrite_images, jsonl_out=args.jsonl_out, ascii_out=args.ascii,
+        batch_size=args.batch_size, workers=args.workers or os.cpu_count() or 1,
+        chunk_size=args.chunk_size, resume=not args.no_resume)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,41 @@
+import argparse
+import hashlib
 import sqlite3
 import os
 import json
+import uuid
+
+import local_search
 
 DB_PATH = 'ecommerce.db'
 DATA_FILE = 'products_data.jsonl'
 
-def init_db():
-    if os.path.exists(DB_PATH):
-        os.remove(DB_PATH)
+# スキーマを変えたら上げる。既存 DB の user_version と違う場合は作り直す
+SCHEMA_VERSION = 4
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+PRODUCT_FIELDS = ('id', 'title', 'category', 'price', 'currency_code', 'image_url', 'availability')
+
+# 一覧のキーセットページネーションと絞り込み(価格帯・在庫)用のカバリング索引。
+# ソートキーの後ろに絞り込み列を含めるので、どの組み合わせでも表を読まずに索引だけで済む。
+# availability で絞る場合は availability が先頭の索引で範囲スキャンになる。
+LISTING_INDEXES = (
+    ('idx_products_category_id', 'products (category, id, price, availability)'),
+    ('idx_products_price_id', 'products (price, id, availability)'),
+    ('idx_products_availability_category', 'products (availability, category, id, price)'),
+    ('idx_products_availability_price', 'products (availability, price, id)'),
+    ('idx_product_categories_price', 'product_categories (category, price, product_id, availability)'),
+    ('idx_product_categories_availability', 'product_categories (category, availability, product_id, price)'),
+    ('idx_product_categories_availability_price', 'product_categories (category, availability, price, product_id)'),
+    ('idx_product_categories_product', 'product_categories (product_id)'),
+)
 
+def create_listing_indexes(cursor):
+    for name, definition in LISTING_INDEXES:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {definition}')
+
+def create_schema(cursor):
     # Updated schema: Remove description, Add currency_code, availability
+    # content_hash は差分取り込みで変更の有無を判定するためのもの
     cursor.execute('''
     CREATE TABLE products (
         id TEXT PRIMARY KEY,
@@ -21,54 +44,530 @@ def init_db():
         price REAL NOT NULL,
         currency_code TEXT NOT NULL,
         image_url TEXT NOT NULL,
-        availability TEXT NOT NULL
+        availability TEXT NOT NULL,
+        content_hash TEXT NOT NULL
+    )
+    ''')
+
+    # カテゴリ別一覧用: 商品とカテゴリの多対多。price と availability を持たせて
+    # 索引だけで価格順・在庫での絞り込みができるようにする
+    cursor.execute('''
+    CREATE TABLE product_categories (
+        category TEXT NOT NULL,
+        product_id TEXT NOT NULL,
+        price REAL NOT NULL,
+        availability TEXT NOT NULL,
+        PRIMARY KEY (category, product_id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE categories (
+        name TEXT PRIMARY KEY,
+        product_count INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    # 一覧では使わない属性(元レコードの残り)。products を細いまま保ち、
+    # 詳細ページだけが主キー 1 回の検索で引く。tags / images / attributes は
+    # 区切りを詰めた JSON で持つ(attributes は上記以外のキー、無ければ NULL)
+    cursor.execute('''
+    CREATE TABLE product_details (
+        product_id TEXT PRIMARY KEY,
+        primary_product_id TEXT,
+        uri TEXT,
+        tags TEXT NOT NULL,
+        images TEXT NOT NULL,
+        attributes TEXT
+    ) WITHOUT ROWID
+    ''')
+    # 変更履歴: 差分反映で変わった商品 id を記録する。アプリのワーカーはこれを読んで
+    # スナップショットの該当商品だけを入れ替える(catalog.py)。
+    # AUTOINCREMENT にして、古い行を消しても seq が再利用されないようにする
+    cursor.execute('''
+    CREATE TABLE product_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id TEXT NOT NULL
+    )
+    ''')
+    # 差分フィード(ingest.py --delta)をどこまで反映したか
+    cursor.execute('''
+    CREATE TABLE delta_offsets (
+        feed TEXT PRIMARY KEY,
+        offset INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    # DB の世代 ID(1 行)。build_db で作り直すたびに新しくなる。作り直した DB では
+    # product_changes の seq が振り直されるので、ワーカーは世代が変わったら
+    # 変更履歴を使わずにスナップショットを丸ごと読み直す(catalog.load_changes)
+    cursor.execute('''
+    CREATE TABLE catalog_generation (
+        id TEXT NOT NULL
     )
     ''')
+    cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+# parse_product() が個別に扱う元レコードのキー。これ以外は attributes にそのまま残す
+DETAIL_HANDLED_KEYS = ('id', 'title', 'categories', 'priceInfo', 'images', 'availability',
+                       'primaryProductId', 'uri', 'tags')
+
+def parse_product(item):
+    # Extract fields
+    p_id = item.get('id')
+    title = item.get('title')
+
+    # Categories is a list, join them
+    categories_list = item.get('categories', [])
+    category = ', '.join(categories_list) if categories_list else 'Uncategorized'
+
+    # priceInfo
+    price_info = item.get('priceInfo', {})
+    price = price_info.get('price', 0)
+    currency_code = price_info.get('currencyCode', 'USD')
+
+    # images
+    images = item.get('images', [])
+    image_url = images[0].get('uri') if images else ''
+
+    availability = item.get('availability', 'OUT_OF_STOCK')
+
+    # products に入らない残りの属性は product_details に入れる
+    attributes = {k: v for k, v in item.items() if k not in DETAIL_HANDLED_KEYS}
+    extra_price_info = {k: v for k, v in price_info.items() if k not in ('price', 'currencyCode')}
+    if extra_price_info:
+        attributes['priceInfo'] = extra_price_info
+
+    product = {
+        'id': p_id,
+        'title': title,
+        'category': category,
+        'price': price,
+        'currency_code': currency_code,
+        'image_url': image_url,
+        'availability': availability,
+        'categories': list(dict.fromkeys(categories_list or ['Uncategorized'])),
+        'primary_product_id': item.get('primaryProductId'),
+        'uri': item.get('uri'),
+        'tags': item.get('tags', []),
+        'images': images,
+        'attributes': attributes or None,
+    }
+    product['content_hash'] = content_hash(product)
+    return product
+
+def content_hash(product):
+    canonical = json.dumps(product, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+def product_row(product):
+    return tuple(product[f] for f in PRODUCT_FIELDS) + (product['content_hash'],)
+
+def compact_json(value):
+    if value is None:
+        return None
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+def detail_row(product):
+    return (product['id'], product['primary_product_id'], product['uri'], compact_json(product['tags']),
+            compact_json(product['images']), compact_json(product['attributes']))
+
+def category_rows(product):
+    return [(name, product['id'], product['price'], product['availability']) for name in product['categories']]
+
+def refresh_category_counts(cursor, names=None):
+    # カテゴリごとの商品数は取り込み時に数えておく
+    if names is None:
+        cursor.execute('DELETE FROM categories')
+        cursor.execute('''
+        INSERT INTO categories (name, product_count)
+        SELECT category, COUNT(*) FROM product_categories GROUP BY category
+        ''')
+        return
+    for name in names:
+        count = cursor.execute('SELECT COUNT(*) FROM product_categories WHERE category = ?', (name,)).fetchone()[0]
+        if count:
+            cursor.execute('INSERT OR REPLACE INTO categories (name, product_count) VALUES (?, ?)', (name, count))
+        else:
+            cursor.execute('DELETE FROM categories WHERE name = ?', (name,))
+
+def batched(iterable, size):
+    # iterable を size 件ずつのリストに分ける(全件をメモリに載せない)
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _placeholders(n):
+    return ', '.join('?' * n)
+
+INSERT_PRODUCT_SQL = ('INSERT INTO products (id, title, category, price, currency_code, image_url, availability, content_hash) '
+                      'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+INSERT_CATEGORY_SQL = 'INSERT INTO product_categories (category, product_id, price, availability) VALUES (?, ?, ?, ?)'
+UPSERT_DETAIL_SQL = ('INSERT OR REPLACE INTO product_details (product_id, primary_product_id, uri, tags, images, attributes) '
+                     'VALUES (?, ?, ?, ?, ?, ?)')
+UPSERT_PRODUCT_SQL = INSERT_PRODUCT_SQL + '''
+ON CONFLICT (id) DO UPDATE SET
+    title = excluded.title, category = excluded.category, price = excluded.price,
+    currency_code = excluded.currency_code, image_url = excluded.image_url,
+    availability = excluded.availability, content_hash = excluded.content_hash
+'''
 
-    products = []
-    seen_ids = set()
-    
-    # Read from products_data.jsonl
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            for line in f:
-                if not line.strip():
-                    continue
-                try:
-                    item = json.loads(line)
-                    
-                    # Extract fields
-                    p_id = item.get('id')
-                    title = item.get('title')
-                    
-                    # Categories is a list, join them
-                    categories_list = item.get('categories', [])
-                    category = ', '.join(categories_list) if categories_list else 'Uncategorized'
-                    
-                    # priceInfo
-                    price_info = item.get('priceInfo', {})
-                    price = price_info.get('price', 0)
-                    currency_code = price_info.get('currencyCode', 'USD')
-                    
-                    # images
-                    images = item.get('images', [])
-                    image_url = images[0].get('uri') if images else ''
-                    
-                    availability = item.get('availability', 'OUT_OF_STOCK')
-
-                    if p_id not in seen_ids:
-                        seen_ids.add(p_id)
-                        products.append((p_id, title, category, price, currency_code, image_url, availability))
-                except json.JSONDecodeError:
-                    print(f"Skipping invalid JSON line: {line[:50]}...")
-                except Exception as e:
-                    print(f"Error processing line: {e}")
-
-    cursor.executemany('INSERT INTO products (id, title, category, price, currency_code, image_url, availability) VALUES (?, ?, ?, ?, ?, ?, ?)', products)
+# 1 バッチの件数。IN (...) のプレースホルダ数の上限 (古い SQLite は 999) より小さくする
+BATCH_SIZE = 500
+
+# 再構築中の一時 DB に、どこまで取り込んだか(フィードの何バイト目まで)を記録する表。
+# 中断しても次回は同じフィードならそこから再開する。完成時に消す
+CHECKPOINT_TABLE = 'ingest_checkpoint'
+
+def load_checkpoint(path, feed_id):
+    # (再開するバイト位置, 取り込み済みの id の集合) を返す。再開できなければ None
+    tmp_path = path + '.tmp'
+    if not os.path.exists(tmp_path):
+        return None
+    conn = sqlite3.connect(tmp_path)
+    try:
+        row = conn.execute(f'SELECT offset FROM {CHECKPOINT_TABLE} WHERE feed = ?', (feed_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0], {p_id for (p_id,) in conn.execute('SELECT id FROM products')}
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+
+def replace_db(tmp_path, path):
+    # 完成した一時 DB の中身を SQLite のバックアップ API で本番の DB にコピーする。
+    # 本番の DB は WAL でワーカーが開いたままなので、ファイルを rename で差し替えると
+    # 古い -wal/-shm が新しい本体に当てられて壊れる。バックアップ API は通常の書き込みと
+    # 同じロックと WAL を通るので、読み手は古い内容か新しい内容のどちらかを一貫して見る
+    src = sqlite3.connect(tmp_path)
+    dst = sqlite3.connect(path)
+    try:
+        dst.execute('PRAGMA busy_timeout = 5000')
+        dst.execute('PRAGMA journal_mode = WAL')
+        src.backup(dst)
+        dst.execute('PRAGMA wal_checkpoint(PASSIVE)')
+    finally:
+        dst.close()
+        src.close()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(tmp_path + suffix):
+            os.remove(tmp_path + suffix)
+
+def build_db(path, products, batch_size=BATCH_SIZE, checkpoint=None, resume=False):
+    # 新しい DB を一時ファイルに作り、完成してから replace_db で本番の DB に書き込む
+    # (スキーマ変更を伴うのでデプロイ時に使う。通常の更新は sync_db)
+    # products は iterable で、batch_size 件ずつ executemany してコミットする。
+    # checkpoint = (feed_id, 現在のバイト位置を返す関数) を渡すと、各バッチと同じ
+    # トランザクションで位置を記録する。resume=True なら既存の一時 DB に追記する
+    tmp_path = path + '.tmp'
+    if not resume:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(tmp_path + suffix):
+                os.remove(tmp_path + suffix)
+
+    conn = sqlite3.connect(tmp_path)
+    # 途中で止まっても一時 DB が壊れないよう WAL にする(コミットごとの fsync は省く)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    cursor = conn.cursor()
+    if not resume:
+        create_schema(cursor)
+        cursor.execute(f'CREATE TABLE {CHECKPOINT_TABLE} (feed TEXT PRIMARY KEY, offset INTEGER NOT NULL)')
+        conn.commit()
+
+    count = cursor.execute('SELECT COUNT(*) FROM products').fetchone()[0] if resume else 0
+    for batch in batched(products, batch_size):
+        cursor.executemany(INSERT_PRODUCT_SQL, [product_row(p) for p in batch])
+        cursor.executemany(INSERT_CATEGORY_SQL, [row for p in batch for row in category_rows(p)])
+        cursor.executemany(UPSERT_DETAIL_SQL, [detail_row(p) for p in batch])
+        if checkpoint is not None:
+            feed_id, position = checkpoint
+            cursor.execute(f'INSERT OR REPLACE INTO {CHECKPOINT_TABLE} (feed, offset) VALUES (?, ?)',
+                           (feed_id, position()))
+        conn.commit()
+        count += len(batch)
+
+    cursor.execute(f'DROP TABLE {CHECKPOINT_TABLE}')
+    # 索引は全件入れてから作る方が速い
+    create_listing_indexes(cursor)
+    refresh_category_counts(cursor)
+
+    # ローカル検索(フォールバック)用の全文検索インデックス
+    local_search.create_index(conn)
+
+    # 置き換えをワーカーに知らせる: 新しい世代 ID を振る。ワーカーは世代が変わったのを見て
+    # スナップショットを丸ごと読み直す。置き換えまでの間に差分フィードが本番の DB に
+    # 書いた seq とは関係なく判定できる
+    cursor.execute('INSERT INTO catalog_generation (id) VALUES (?)', (uuid.uuid4().hex,))
+
+    # 索引選択のための統計を取っておく
+    cursor.execute('ANALYZE')
 
     conn.commit()
+    # 一時 DB の -wal の中身を本体に書き戻してからコピーする
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+    replace_db(tmp_path, path)
+    print(f"Database {path} initialized with {count} products.")
+    return count
+
+# 変更履歴は新しい方からこの件数だけ残す。これより古い変更を読めなかった
+# ワーカーはスナップショットを丸ごと読み直す
+CHANGE_LOG_SIZE = 100000
+
+def log_changes(cursor, product_ids):
+    cursor.executemany('INSERT INTO product_changes (product_id) VALUES (?)', [(i,) for i in product_ids])
+
+def prune_changes(cursor, keep=CHANGE_LOG_SIZE):
+    cursor.execute('DELETE FROM product_changes WHERE seq <= (SELECT MAX(seq) FROM product_changes) - ?', (keep,))
+
+def upsert_products(conn, products, has_fts):
+    # id が重複しない products を反映する。content_hash が同じ商品は何もしない。
+    # (inserted, updated, unchanged, 変わった商品の id, 影響したカテゴリ) を返す
+    cursor = conn.cursor()
+    ids = [p['id'] for p in products]
+    existing = {row[0]: row[1:] for row in cursor.execute(
+        f'SELECT id, rowid, content_hash, title, category FROM products WHERE id IN ({_placeholders(len(ids))})',
+        ids)}
+
+    changed = []
+    old_ids = []
+    old_fts_rows = []
+    for product in products:
+        current = existing.get(product['id'])
+        if current is not None and current[1] == product['content_hash']:
+            continue
+        changed.append(product)
+        if current is not None:
+            rowid, _, old_title, old_category = current
+            old_ids.append(product['id'])
+            old_fts_rows.append((rowid, old_title, old_category))
+    unchanged = len(products) - len(changed)
+    touched_categories = set()
+    if not changed:
+        return 0, 0, unchanged, [], touched_categories
+
+    if old_ids:
+        if has_fts:
+            local_search.unindex_products(conn, old_fts_rows)
+        touched_categories.update(name for (name,) in cursor.execute(
+            f'SELECT DISTINCT category FROM product_categories WHERE product_id IN ({_placeholders(len(old_ids))})',
+            old_ids))
+        cursor.executemany('DELETE FROM product_categories WHERE product_id = ?', [(i,) for i in old_ids])
+
+    cursor.executemany(UPSERT_PRODUCT_SQL, [product_row(p) for p in changed])
+    cursor.executemany(INSERT_CATEGORY_SQL, [row for p in changed for row in category_rows(p)])
+    cursor.executemany(UPSERT_DETAIL_SQL, [detail_row(p) for p in changed])
+    for product in changed:
+        touched_categories.update(product['categories'])
+    changed_ids = [p['id'] for p in changed]
+    if has_fts:
+        local_search.index_products(conn, cursor.execute(
+            f'SELECT rowid, title, category FROM products WHERE id IN ({_placeholders(len(changed_ids))})',
+            changed_ids).fetchall())
+    return len(changed) - len(old_ids), len(old_ids), unchanged, changed_ids, touched_categories
+
+def delete_products(conn, product_ids, has_fts):
+    # 削除した商品の id と影響したカテゴリを返す
+    cursor = conn.cursor()
+    rows = cursor.execute(
+        f'SELECT id, rowid, title, category FROM products WHERE id IN ({_placeholders(len(product_ids))})',
+        list(product_ids)).fetchall()
+    deleted_ids = [row[0] for row in rows]
+    touched_categories = set()
+    if not rows:
+        return deleted_ids, touched_categories
+    if has_fts:
+        local_search.unindex_products(conn, [row[1:] for row in rows])
+    touched_categories.update(name for (name,) in cursor.execute(
+        f'SELECT DISTINCT category FROM product_categories WHERE product_id IN ({_placeholders(len(deleted_ids))})',
+        deleted_ids))
+    cursor.executemany('DELETE FROM product_categories WHERE product_id = ?', [(i,) for i in deleted_ids])
+    cursor.executemany('DELETE FROM product_details WHERE product_id = ?', [(i,) for i in deleted_ids])
+    cursor.executemany('DELETE FROM products WHERE id = ?', [(i,) for i in deleted_ids])
+    return deleted_ids, touched_categories
+
+def sync_db(path, products, batch_size=BATCH_SIZE):
+    # 既存 DB との差分だけを 1 トランザクションで反映する。
+    # チェックポイントは取らない(再開できるのは build_db だけ)。途中で止まれば全体が
+    # ロールバックされて元の DB のままなので、最初から実行し直せばよい。
+    # content_hash が変わった商品だけを更新し、フィードから消えた商品は削除する。
+    # WAL なので反映中も読み取り側は直前の状態を読み続けられる。
+    # 既存行は batch_size 件ずつ id で引いて比較するので、メモリは件数に比例しない
+    # (フィードに出てきた id は一時表 feed_ids に入れ、最後に削除対象を求める)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA busy_timeout = 5000')
+    conn.execute('PRAGMA temp_store = FILE')
+    cursor = conn.cursor()
+    has_fts = local_search.has_index(conn)
+
+    inserted = updated = deleted = unchanged = 0
+    touched_categories = set()
+
+    with conn:
+        cursor.execute('CREATE TEMP TABLE feed_ids (id TEXT PRIMARY KEY) WITHOUT ROWID')
+        for batch in batched(products, batch_size):
+            cursor.executemany('INSERT OR IGNORE INTO feed_ids (id) VALUES (?)', [(p['id'],) for p in batch])
+            i, u, n, changed_ids, categories = upsert_products(conn, batch, has_fts)
+            inserted += i
+            updated += u
+            unchanged += n
+            touched_categories |= categories
+            log_changes(cursor, changed_ids)
+
+        # フィードに無くなった商品を削除する
+        gone = [p_id for (p_id,) in cursor.execute(
+            'SELECT id FROM products WHERE id NOT IN (SELECT id FROM feed_ids)').fetchall()]
+        for batch in batched(gone, batch_size):
+            deleted_ids, categories = delete_products(conn, batch, has_fts)
+            deleted += len(deleted_ids)
+            touched_categories |= categories
+            log_changes(cursor, deleted_ids)
+
+        refresh_category_counts(cursor, touched_categories)
+        prune_changes(cursor)
+        cursor.execute('DROP TABLE feed_ids')
+
     conn.close()
-    print(f"Database {DB_PATH} initialized with {len(products)} products.")
+    print(f"Database {path} synced: {inserted} inserted, {updated} updated, "
+          f"{deleted} deleted, {unchanged} unchanged.")
+    return inserted + updated + unchanged
+
+def stored_record(conn, product_id):
+    # DB に入っている商品をフィードの元レコードの形に戻す(無ければ None)。
+    # parse_product() に通すと同じ商品になる
+    row = conn.execute(
+        'SELECT p.title, p.category, p.price, p.currency_code, p.availability, '
+        'd.primary_product_id, d.uri, d.tags, d.images, d.attributes '
+        'FROM products p LEFT JOIN product_details d ON d.product_id = p.id WHERE p.id = ?',
+        (product_id,)).fetchone()
+    if row is None:
+        return None
+    title, category, price, currency_code, availability, primary_id, uri, tags, images, attributes = row
+    names = [r[0] for r in conn.execute('SELECT category FROM product_categories WHERE product_id = ?', (product_id,))]
+    # categories の並びは products.category(', ' 区切り)に残っている
+    categories = category.split(', ') if set(category.split(', ')) == set(names) else sorted(names)
+    attributes = json.loads(attributes) if attributes else {}
+    # REAL で戻る価格はフィードと同じく整数なら整数にする(content_hash が変わらないように)
+    if isinstance(price, float) and price.is_integer():
+        price = int(price)
+    price_info = dict(attributes.pop('priceInfo', {}), price=price, currencyCode=currency_code)
+    record = dict(attributes)
+    record.update({
+        'id': product_id,
+        'title': title,
+        'categories': [] if categories == ['Uncategorized'] else categories,
+        'priceInfo': price_info,
+        'images': json.loads(images) if images else [],
+        'availability': availability,
+        'tags': json.loads(tags) if tags else [],
+    })
+    if primary_id is not None:
+        record['primaryProductId'] = primary_id
+    if uri is not None:
+        record['uri'] = uri
+    return record
+
+def merge_record(base, patch):
+    # 部分 upsert を元のレコードに重ねる。priceInfo は中身ごとに重ねる(price だけの変更など)
+    merged = dict(base)
+    for key, value in patch.items():
+        if key == 'priceInfo' and isinstance(base.get(key), dict):
+            merged[key] = dict(base[key], **value)
+        else:
+            merged[key] = value
+    return merged
+
+def apply_delta(conn, ops, feed=None, offset=None):
+    # 差分フィードの 1 バッチ [('upsert', 元レコード) / ('delete', id)] を 1 トランザクションで反映する。
+    # upsert は部分でもよく、DB の商品(同じバッチで先に upsert されていればその結果)に重ねる。
+    # 新しい商品で title が無いなど、重ねても商品にならない行はログに出して飛ばす。
+    # 同じ id が複数回あれば最後の操作が勝つ。feed/offset を渡すと同じトランザクションで
+    # 読み終えた位置を記録するので、落ちても二重に反映したり取りこぼしたりしない
+    latest = {}   # id -> (op, 重ねた元レコード or id, 商品 or None)
+    for op, value in ops:
+        if op == 'delete':
+            latest.pop(value, None)
+            latest[value] = (op, value, None)
+            continue
+        p_id = value['id']
+        previous = latest.get(p_id)
+        if previous is None:
+            base = stored_record(conn, p_id)
+        else:
+            base = previous[1] if previous[0] == 'upsert' else None
+        record = merge_record(base, value) if base else value
+        if not record.get('title'):
+            print(f"Skipping partial upsert for unknown product {p_id}: new products need a title")
+            continue
+        try:
+            product = parse_product(record)
+        except Exception as e:
+            print(f"Skipping upsert for {p_id}: {e}")
+            continue
+        latest.pop(p_id, None)
+        latest[p_id] = (op, record, product)
+    upserts = [product for op, _, product in latest.values() if op == 'upsert']
+    deletes = [p_id for p_id, (op, _, _) in latest.items() if op == 'delete']
+
+    has_fts = local_search.has_index(conn)
+    cursor = conn.cursor()
+    inserted = updated = 0
+    deleted_ids = []
+    with conn:
+        touched_categories = set()
+        if upserts:
+            inserted, updated, _, changed_ids, categories = upsert_products(conn, upserts, has_fts)
+            touched_categories |= categories
+            log_changes(cursor, changed_ids)
+        if deletes:
+            deleted_ids, categories = delete_products(conn, deletes, has_fts)
+            touched_categories |= categories
+            log_changes(cursor, deleted_ids)
+        refresh_category_counts(cursor, touched_categories)
+        prune_changes(cursor)
+        if feed is not None:
+            cursor.execute('INSERT OR REPLACE INTO delta_offsets (feed, offset) VALUES (?, ?)', (feed, offset))
+    return inserted, updated, len(deleted_ids)
+
+def delta_offset(conn, feed):
+    row = conn.execute('SELECT offset FROM delta_offsets WHERE feed = ?', (feed,)).fetchone()
+    return row[0] if row else 0
+
+def schema_version(path):
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+
+def needs_rebuild(path):
+    # DB が無い・スキーマが古い場合は作り直し、それ以外は差分だけ反映する
+    return schema_version(path) != SCHEMA_VERSION
+
+def init_db(rebuild=False, data_file=DATA_FILE, db_path=DB_PATH, workers=1, resume=True):
+    # 取り込みの本体は ingest.py のパイプライン(読み込み → 正規化 → 重複除去 → DB)
+    import ingest
+    ingest.run(data_file, db_path=db_path, rebuild=rebuild, workers=workers, resume=resume)
 
 if __name__ == '__main__':
-    init_db()
+    parser = argparse.ArgumentParser(description='Load the product feed (JSONL, optionally gzip/bz2/xz) into the SQLite catalog.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='build a fresh database and atomically replace the current one')
+    parser.add_argument('--data-file', default=DATA_FILE)
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='parse the feed in this many processes (0: one per CPU)')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='ignore the checkpoint of an interrupted rebuild and start over. '
+                             'Only --rebuild (or a schema upgrade) is checkpointed and resumable; '
+                             'the default sync runs in one transaction, so an interrupted sync '
+                             'leaves the database unchanged and is simply run again from the start')
+    args = parser.parse_args()
+    init_db(rebuild=args.rebuild, data_file=args.data_file, db_path=args.db,
+            workers=args.workers or os.cpu_count() or 1, resume=not args.no_resume)
@@ -0,0 +1,195 @@
+import argparse
+import sqlite3
+import threading
+import time
+
+import db
+
+# 商品ごとの在庫数(inventory.db の inventory テーブル)。
+# /complete で注文の全明細の在庫を 1 トランザクションでまとめて引き当てる:
+#   UPDATE inventory SET stock = stock - ? WHERE product_id = ? AND stock >= ?
+# 条件付きの UPDATE なので、読んでから書くまでの間に他の注文に取られて売り越すことがない。
+# 1 明細でも足りなければ全体をロールバックし、足りない商品と残り在庫を返す。
+# 在庫の行が無い商品は在庫管理の対象外(数量の制限なし)として扱う。
+#
+# SQLite は書き込みを 1 本ずつしか通さない(行ではなく DB 単位で待つ)ので、人気商品に
+# 注文が集中しても商品がばらけていても待ち方は同じ。同じプロセスのスレッドどうしは
+# Python のロックで順番に並べてから BEGIN IMMEDIATE する。SQLite のロック待ち
+# (busy_timeout)はスリープしてから再試行するので、スレッドが多いとスループットが落ちるが、
+# ロックで並べれば待っているスレッドは前の commit が終わった時点ですぐに入れる。
+# 引き当ては synchronous = NORMAL(WAL)で commit するので fsync を待たない
+# (プロセスが落ちても失われず、失われうるのは OS ごと落ちた場合の直前の分だけ)。
+# 注文(orders.db)とは DB を分けている。同じファイルだと書き込みのロックを注文の
+# 書き込みスレッドと取り合い、引き当てが synchronous = FULL の commit(fsync)を待たされる。
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS inventory (
+        product_id TEXT PRIMARY KEY,
+        stock INTEGER NOT NULL CHECK (stock >= 0),
+        updated_at REAL NOT NULL
+    ) WITHOUT ROWID;
+'''
+
+DB_PATH = 'inventory.db'
+
+
+def merge_lines(lines):
+    # [(product_id, quantity)] を商品ごとにまとめる
+    quantities = {}
+    for product_id, quantity in lines:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return quantities
+
+
+class Inventory:
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self.reservations = 0
+        self.rejected = 0
+        self.releases = 0
+        self.lock_wait = 0.0
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.executescript(SCHEMA)
+
+    def _conn(self):
+        # スレッドごとの接続。トランザクションは自分で BEGIN/COMMIT する
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = db.connect(self.path, readonly=False)
+            conn.isolation_level = None
+            conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def _write(self, fn):
+        conn = self._conn()
+        start = time.perf_counter()
+        with self._write_lock:
+            self.lock_wait += time.perf_counter() - start
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(conn)
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            if result:
+                # 失敗(足りない商品がある)ときは何も変えずに戻す
+                conn.execute('ROLLBACK')
+            else:
+                conn.execute('COMMIT')
+            return result
+
+    def reserve(self, lines):
+        # 在庫を引き当てる。成功なら空の dict、足りなければ {product_id: 残り在庫}
+        quantities = merge_lines(lines)
+        if not quantities:
+            return {}
+        now = time.time()
+
+        def reserve_all(conn):
+            ids = list(quantities)
+            # BEGIN IMMEDIATE の中なので、読んだ在庫はこのトランザクションの間は変わらない
+            stock = dict(conn.execute(
+                f'SELECT product_id, stock FROM inventory WHERE product_id IN ({", ".join("?" * len(ids))})',
+                ids).fetchall())
+            shortages = {pid: available for pid, available in stock.items() if available < quantities[pid]}
+            if shortages or not stock:
+                return shortages
+            cursor = conn.executemany(
+                'UPDATE inventory SET stock = stock - ?, updated_at = ? WHERE product_id = ? AND stock >= ?',
+                [(quantities[pid], now, pid, quantities[pid]) for pid in stock])
+            if cursor.rowcount != len(stock):
+                raise sqlite3.DatabaseError('inventory changed during reservation')
+            return {}
+
+        shortages = self._write(reserve_all)
+        if shortages:
+            self.rejected += 1
+        else:
+            self.reservations += 1
+        return shortages
+
+    def release(self, lines):
+        # 引き当てた在庫を戻す(注文を保存できなかった場合など)
+        quantities = merge_lines(lines)
+        now = time.time()
+
+        def release_all(conn):
+            conn.executemany('UPDATE inventory SET stock = stock + ?, updated_at = ? WHERE product_id = ?',
+                             [(qty, now, pid) for pid, qty in quantities.items()])
+            return None
+
+        self._write(release_all)
+        self.releases += 1
+
+    def set_stock(self, stock):
+        now = time.time()
+
+        def set_all(conn):
+            conn.executemany('INSERT OR REPLACE INTO inventory (product_id, stock, updated_at) VALUES (?, ?, ?)',
+                             [(pid, qty, now) for pid, qty in stock.items()])
+            return None
+
+        self._write(set_all)
+
+    def get_stock(self, product_ids, chunk_size=500):
+        product_ids = list(product_ids)
+        stock = {}
+        for i in range(0, len(product_ids), chunk_size):
+            chunk = product_ids[i:i + chunk_size]
+            stock.update(self._conn().execute(
+                f'SELECT product_id, stock FROM inventory WHERE product_id IN ({", ".join("?" * len(chunk))})',
+                chunk).fetchall())
+        return stock
+
+    def stats(self):
+        return {
+            'reservations': self.reservations,
+            'rejected': self.rejected,
+            'releases': self.releases,
+            'lock_wait': self.lock_wait,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage per-product stock')
+    parser.add_argument('--db', default=DB_PATH, help='Inventory database')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('set', help='set stock: set ID QTY [ID QTY ...]')
+    p.add_argument('pairs', nargs='+')
+
+    p = sub.add_parser('seed', help='give every IN_STOCK catalog product without a stock row QTY units')
+    p.add_argument('quantity', type=int)
+    p.add_argument('--catalog', default='ecommerce.db', help='Catalog database')
+
+    p = sub.add_parser('show', help='print stock for the given product IDs')
+    p.add_argument('ids', nargs='+')
+
+    args = parser.parse_args()
+    inventory = Inventory(args.db)
+    if args.command == 'set':
+        if len(args.pairs) % 2:
+            parser.error('set takes ID QTY pairs')
+        stock = {pid: int(qty) for pid, qty in zip(args.pairs[::2], args.pairs[1::2])}
+        inventory.set_stock(stock)
+        print(f"Set stock for {len(stock)} products")
+    elif args.command == 'seed':
+        conn = db.connect(args.catalog)
+        ids = [row[0] for row in conn.execute("SELECT id FROM products WHERE availability = 'IN_STOCK'")]
+        conn.close()
+        existing = inventory.get_stock(ids)
+        stock = {pid: args.quantity for pid in ids if pid not in existing}
+        inventory.set_stock(stock)
+        print(f"Seeded stock for {len(stock)} products ({len(existing)} already had stock)")
+    else:
+        stock = inventory.get_stock(args.ids)
+        for pid in args.ids:
+            print(f"{pid}\t{stock.get(pid, 'untracked')}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import sqlite3
+
+from catalog import NO_FILTER, filter_clauses
+from search_cache import SearchResult
+
+# Vertex AI Search が使えないとき(障害時・負荷試験・オフライン開発)のための
+# ローカル検索。init_db.py が作る products_fts (FTS5 trigram) を BM25 順で引く。
+# trigram は 3 文字未満の語にマッチできないので、短い語は LIKE で絞り込む。
+FTS_TABLE = 'products_fts'
+MIN_TRIGRAM_LENGTH = 3
+
+SORT_ORDER = {
+    'price_asc': 'p.price, p.id',
+    'price_desc': 'p.price DESC, p.id DESC',
+}
+
+
+def create_index(conn):
+    # products を外部コンテンツとして参照する FTS インデックスを作り直す
+    conn.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+    try:
+        conn.execute(f'''
+        CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+            title, category,
+            content='products', content_rowid='rowid',
+            tokenize='trigram'
+        )
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite 3.34 未満には trigram トークナイザがない。その場合は LIKE 検索になる
+        print(f"FTS5 trigram index not available ({e}); local search will use LIKE.")
+        return False
+    conn.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    return True
+
+
+def index_products(conn, rows):
+    # rows: (rowid, title, category) の iterable
+    conn.executemany(f'INSERT INTO {FTS_TABLE}(rowid, title, category) VALUES (?, ?, ?)', rows)
+
+
+def unindex_products(conn, rows):
+    # 外部コンテンツ FTS は削除時に元の値を渡す必要がある
+    conn.executemany(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, category) VALUES ('delete', ?, ?, ?)",
+                     rows)
+
+
+def has_index(conn):
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,)
+    ).fetchone()
+    return row is not None
+
+
+def _like_pattern(term):
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def search(conn, query, limit=10, offset=0, filters=NO_FILTER, sort='relevance'):
+    terms = query.split()
+    if not terms:
+        return SearchResult(product_ids=(), attribution_token=None, next_page_token='', total_size=0)
+
+    use_fts = has_index(conn)
+    fts_terms = [t for t in terms if len(t) >= MIN_TRIGRAM_LENGTH] if use_fts else []
+    like_terms = [t for t in terms if t not in fts_terms]
+
+    where, params = filter_clauses(filters, price_column='p.price', availability_column='p.availability')
+    for term in like_terms:
+        where.append("(p.title LIKE ? ESCAPE '\\' OR p.category LIKE ? ESCAPE '\\')")
+        params.extend([_like_pattern(term)] * 2)
+
+    if fts_terms:
+        # 各語をフレーズとして AND 検索する
+        match = ' '.join('"{}"'.format(t.replace('"', '""')) for t in fts_terms)
+        sql = (f'SELECT p.id FROM {FTS_TABLE} f JOIN products p ON p.rowid = f.rowid '
+               f'WHERE {FTS_TABLE} MATCH ?')
+        params.insert(0, match)
+        if where:
+            sql += ' AND ' + ' AND '.join(where)
+        order = f'bm25({FTS_TABLE})'
+    else:
+        sql = 'SELECT p.id FROM products p WHERE ' + ' AND '.join(where)
+        order = 'p.id'
+    if sort in SORT_ORDER:
+        order = SORT_ORDER[sort]
+    sql += f' ORDER BY {order} LIMIT ? OFFSET ?'
+    # 次ページの有無を知るため 1 件多く取る
+    params.extend([limit + 1, offset])
+
+    rows = conn.execute(sql, params).fetchall()
+    has_next = len(rows) > limit
+    return SearchResult(product_ids=tuple(str(row[0]) for row in rows[:limit]),
+                        attribution_token=None,
+                        next_page_token=str(offset + limit) if has_next else '',
+                        total_size=None)
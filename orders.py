@@ -0,0 +1,179 @@
+import queue
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+import db
+
+# 注文の保存(orders.db)。
+# /complete では注文を組み立ててキューに入れるだけで、書き込みはバックグラウンドの
+# 1 スレッドがまとめて行う(write-behind)。溜まっている注文は 1 トランザクションで
+# まとめて commit する(group commit)ので、fsync は注文ごとではなくまとめて 1 回で済み、
+# チェックアウトの応答時間にも含まれない。
+# キューには上限があり、書き込みが追いつかないときは submit() が空くまで待つ(注文は捨てない)。
+# 終了時は close() でキューを書き切ってから止める(app.py で atexit に登録している)。
+# カタログ DB は作り直しで置き換えられるので、注文は別の DB に置く。
+
+Order = namedtuple('Order', ['id', 'created_at', 'visitor_id', 'total_price', 'currency_code', 'items'])
+OrderItem = namedtuple('OrderItem', ['product_id', 'title', 'price', 'quantity', 'item_total'])
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS orders (
+        id TEXT PRIMARY KEY,
+        created_at REAL NOT NULL,
+        visitor_id TEXT,
+        total_price REAL NOT NULL,
+        currency_code TEXT NOT NULL,
+        item_count INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at);
+    CREATE TABLE IF NOT EXISTS order_items (
+        order_id TEXT NOT NULL,
+        product_id TEXT NOT NULL,
+        title TEXT NOT NULL,
+        price REAL NOT NULL,
+        quantity INTEGER NOT NULL,
+        item_total REAL NOT NULL,
+        PRIMARY KEY (order_id, product_id)
+    ) WITHOUT ROWID;
+'''
+
+QUEUE_SIZE = 1000
+BATCH_SIZE = 100
+RETRY_INTERVAL = 1.0   # 書き込みに失敗したときの再試行間隔(秒、失敗が続くと倍にしていく)
+MAX_RETRY_INTERVAL = 30.0
+
+
+def new_order(priced, visitor_id=None, now=None):
+    # cart_pricing.price_cart() の結果から注文を作る。注文の合計は 1 つの通貨で持つので、
+    # 通貨の混ざったカートは受け付けない(complete() で先に弾いている)
+    if priced.mixed_currency:
+        raise ValueError(f'Cannot create an order from a mixed-currency cart: {sorted(priced.totals)}')
+    items = [OrderItem(product_id=line.product['id'], title=line.product['title'],
+                       price=line.product['price'], quantity=line.quantity,
+                       item_total=line.item_total)
+             for line in priced.lines]
+    return Order(id=uuid.uuid4().hex, created_at=time.time() if now is None else now,
+                 visitor_id=visitor_id, total_price=priced.total_price,
+                 currency_code=priced.currency_code, items=items)
+
+
+def connect(path):
+    conn = db.connect(path, readonly=False)
+    conn.execute('PRAGMA journal_mode = WAL')
+    # commit ごとに fsync する(まとめて commit するので回数は注文数より少ない)
+    conn.execute('PRAGMA synchronous = FULL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def write_orders(conn, orders):
+    # orders を 1 トランザクションで書き込む
+    with conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO orders (id, created_at, visitor_id, total_price, currency_code, item_count) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [(o.id, o.created_at, o.visitor_id, o.total_price, o.currency_code,
+              sum(item.quantity for item in o.items)) for o in orders])
+        conn.executemany(
+            'INSERT OR IGNORE INTO order_items (order_id, product_id, title, price, quantity, item_total) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [(o.id, item.product_id, item.title, item.price, item.quantity, item.item_total)
+             for o in orders for item in o.items])
+
+
+class OrderWriter:
+    _STOP = object()
+
+    def __init__(self, path, maxsize=QUEUE_SIZE, batch_size=BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._closed = False
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.written = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.failures = 0
+        self.blocked = 0
+        # スキーマはここで作っておく(書き込みスレッドの接続は別に開く)
+        connect(path).close()
+        self._thread = threading.Thread(target=self._run, name='order-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, order):
+        # キューに入れるまでロックを持つ。close() が _STOP を入れた後に注文が入って
+        # 書かれないまま捨てられることがない(満杯で待つ間は close() も待つ)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('OrderWriter is closed')
+            self.submitted += 1
+            try:
+                self._queue.put_nowait(order)
+            except queue.Full:
+                # 書き込みが追いつくまで待つ(書き込みスレッドはこのロックを使わない)
+                self.blocked += 1
+                self._queue.put(order)
+
+    def flush(self):
+        # それまでに submit された注文がすべて書き込まれるまで待つ
+        self._queue.join()
+
+    def close(self, timeout=None):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print(f"Order writer did not finish within {timeout}s; {self._queue.qsize()} orders pending")
+        else:
+            print(f"Order writer stopped: {self.written} orders written in {self.batches} batches")
+
+    def _take_batch(self):
+        # 1 件目は来るまで待ち、あとはその時点で溜まっている分を batch_size まで取る
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        conn = connect(self.path)
+        stopping = False
+        while not stopping:
+            batch = self._take_batch()
+            orders = [o for o in batch if o is not self._STOP]
+            stopping = len(orders) < len(batch)
+            interval = RETRY_INTERVAL
+            while orders:
+                try:
+                    write_orders(conn, orders)
+                    break
+                except Exception as e:
+                    self.failures += 1
+                    print(f"Failed to write {len(orders)} orders (retrying in {interval:.0f}s): {e}")
+                    time.sleep(interval)
+                    interval = min(interval * 2, MAX_RETRY_INTERVAL)
+            self.written += len(orders)
+            self.batches += 1 if orders else 0
+            self.max_batch = max(self.max_batch, len(orders))
+            for _ in batch:
+                self._queue.task_done()
+        conn.close()
+
+    def stats(self):
+        return {
+            'submitted': self.submitted,
+            'written': self.written,
+            'pending': self._queue.qsize(),
+            'batches': self.batches,
+            'max_batch': self.max_batch,
+            'blocked': self.blocked,
+            'failures': self.failures,
+        }
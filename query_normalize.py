@@ -0,0 +1,21 @@
+import re
+import unicodedata
+
+# 検索クエリの正規化。キャッシュキー・single-flight のキー・Vertex AI に送る
+# クエリはすべてこの正規形を使うので、表記ゆれが同じキャッシュエントリに集まる。
+#   "Ｈｏｏｄｉｅ" / "hoodie " / "HOODIE" -> "hoodie"
+#   "ﾊﾟｰｶｰ" -> "パーカー"
+
+_WHITESPACE = re.compile(r'\s+')
+
+# ひらがな(ぁ-ゖ, ゝゞ)をカタカナに寄せる
+_HIRAGANA_TO_KATAKANA = {code: code + 0x60 for code in range(0x3041, 0x3097)}
+_HIRAGANA_TO_KATAKANA.update({0x309D: 0x30FD, 0x309E: 0x30FE})
+
+
+def normalize_query(query, kana=False):
+    # NFKC で全角英数・半角カナ・全角スペースなどを統一してから casefold する
+    text = unicodedata.normalize('NFKC', query).casefold()
+    if kana:
+        text = text.translate(_HIRAGANA_TO_KATAKANA)
+    return _WHITESPACE.sub(' ', text).strip()
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+# products_data.jsonl の元レコードを id から直接引くためのオフセット索引。
+# 索引ファイル(DB の隣の ecommerce.db.rawidx)は id のハッシュ → (行の位置, 長さ) の
+# オープンアドレス法のハッシュ表で、フィードと索引の両方を mmap して引くので
+# 1 件あたりの探索は O(1)、返す値はフィードの mmap の memoryview スライス(コピーなし)。
+# id そのものは持たず 64 ビットのハッシュの一致で判定する(衝突は実用上無視できる)。
+# 索引にはフィードの (サイズ, mtime, inode) を記録しておき、フィードが変わっていたら
+# 使わずに作り直す。索引は ingest.py の取り込みと同じパスで作られる。
+# フィードは rename で置き換えること(その場で書き換えると mmap 中の読み取りが SIGBUS になりうる)。
+#
+# ファイル形式(数値はネイティブのバイト順):
+#   header: magic, feed size, feed mtime_ns, feed inode, slots, path length (48 バイト)
+#   feed path (8 バイト境界まで詰める)
+#   hashes  u64 * slots   (0 は空き)
+#   offsets u64 * slots
+#   lengths u32 * slots
+
+MAGIC = b'RAWIDX01'
+HEADER = struct.Struct('=8sQQQQI4x')
+
+
+def index_path_for(db_path):
+    return db_path + '.rawidx'
+
+
+def key_hash(product_id):
+    h = int.from_bytes(hashlib.blake2b(product_id.encode('utf-8'), digest_size=8).digest(), 'little')
+    # 0 は空きスロットの印なので使わない
+    return h or 1
+
+
+def feed_fingerprint(feed_path):
+    st = os.stat(feed_path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class IndexBuilder:
+    # 取り込み中に (id, 行の開始位置, 行の長さ) を受け取り、最後にファイルへ書き出す。
+    # 同じ id は最初の行を使う(取り込みの重複除去と同じ)
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.hashes = array('Q')
+        self.offsets = array('Q')
+        self.lengths = array('I')
+
+    def add(self, product_id, offset, length):
+        if not isinstance(product_id, str) or not product_id:
+            return
+        self.hashes.append(key_hash(product_id))
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def write(self, index_path, feed_path):
+        # 負荷率 0.5 以下になるよう 2 のべき乗のスロット数にする
+        slots = 8
+        while slots < len(self.hashes) * 2:
+            slots *= 2
+        mask = slots - 1
+        table_hashes = array('Q', bytes(8 * slots))
+        table_offsets = array('Q', bytes(8 * slots))
+        table_lengths = array('I', bytes(4 * slots))
+        for h, offset, length in zip(self.hashes, self.offsets, self.lengths):
+            i = h & mask
+            while table_hashes[i] and table_hashes[i] != h:
+                i = (i + 1) & mask
+            if table_hashes[i]:
+                continue
+            table_hashes[i] = h
+            table_offsets[i] = offset
+            table_lengths[i] = length
+
+        path = os.path.abspath(feed_path).encode('utf-8')
+        size, mtime_ns, inode = self.fingerprint
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, size, mtime_ns, inode, slots, len(path)))
+            f.write(path + b'\0' * (-len(path) % 8))
+            table_hashes.tofile(f)
+            table_offsets.tofile(f)
+            table_lengths.tofile(f)
+        os.replace(tmp_path, index_path)
+
+
+def scan_feed(feed_path, builder):
+    # フィードを 1 回読んで索引を作る(取り込み以外で作り直す場合)
+    offset = 0
+    with open(feed_path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                try:
+                    builder.add(json.loads(line).get('id'), offset, len(line))
+                except (ValueError, AttributeError):
+                    pass
+            offset += len(line)
+    return builder
+
+
+def build_index(feed_path, index_path):
+    builder = scan_feed(feed_path, IndexBuilder(feed_fingerprint(feed_path)))
+    builder.write(index_path, feed_path)
+    return len(builder)
+
+
+class _Mapped:
+    # 開いた索引とフィードの mmap。差し替え後も、返したスライスが参照している間は生きている
+    def __init__(self, feed_path, index_path):
+        with open(index_path, 'rb') as f:
+            self.index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size, mtime_ns, inode, slots, path_len = HEADER.unpack_from(self.index_map, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{index_path} is not a raw product index')
+        self.fingerprint = (size, mtime_ns, inode)
+        self.slots = slots
+        start = HEADER.size + path_len + (-path_len % 8)
+        view = memoryview(self.index_map)
+        self.hashes = view[start:start + 8 * slots].cast('Q')
+        self.offsets = view[start + 8 * slots:start + 16 * slots].cast('Q')
+        self.lengths = view[start + 16 * slots:start + 20 * slots].cast('I')
+        with open(feed_path, 'rb') as f:
+            self.feed_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.feed = memoryview(self.feed_map)
+
+    def get(self, product_id):
+        h = key_hash(product_id)
+        mask = self.slots - 1
+        i = h & mask
+        while True:
+            slot_hash = self.hashes[i]
+            if slot_hash == 0:
+                return None
+            if slot_hash == h:
+                break
+            i = (i + 1) & mask
+        start = self.offsets[i]
+        end = min(start + self.lengths[i], len(self.feed))
+        # 行末の改行は含めない
+        while end > start and self.feed[end - 1] in (0x0a, 0x0d):
+            end -= 1
+        return self.feed[start:end]
+
+
+class RawIndex:
+    def __init__(self, feed_path, index_path, check_interval=1.0):
+        self.feed_path = feed_path
+        self.index_path = index_path
+        self.check_interval = check_interval
+        self._mapped = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.rebuilds = 0
+        self.lookups = 0
+        self.misses = 0
+
+    def _current(self, now):
+        mapped = self._mapped
+        if mapped is not None and now - self._checked_at < self.check_interval:
+            return mapped
+        with self._lock:
+            self._checked_at = now
+            fingerprint = feed_fingerprint(self.feed_path)
+            if self._mapped is not None and self._mapped.fingerprint == fingerprint:
+                return self._mapped
+            try:
+                mapped = _Mapped(self.feed_path, self.index_path)
+            except (OSError, ValueError, struct.error):
+                mapped = None
+            if mapped is None or mapped.fingerprint != fingerprint:
+                # 索引が無い・フィードが変わっている場合は作り直す
+                count = build_index(self.feed_path, self.index_path)
+                self.rebuilds += 1
+                print(f"Rebuilt raw product index {self.index_path}: {count} records")
+                mapped = _Mapped(self.feed_path, self.index_path)
+            self._mapped = mapped
+            return mapped
+
+    def get_raw_product(self, product_id, now=None):
+        # 元レコードの JSON(bytes の memoryview)。無ければ None
+        mapped = self._current(time.monotonic() if now is None else now)
+        self.lookups += 1
+        raw = mapped.get(product_id)
+        if raw is None:
+            self.misses += 1
+        return raw
+
+    def stats(self):
+        mapped = self._mapped
+        return {
+            'slots': mapped.slots if mapped else 0,
+            'rebuilds': self.rebuilds,
+            'lookups': self.lookups,
+            'misses': self.misses,
+        }
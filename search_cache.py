@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# キャッシュに載せる検索結果。レスポンス本体ではなく必要な値だけを保持する
+SearchResult = namedtuple('SearchResult', ['product_ids', 'attribution_token',
+                                           'next_page_token', 'total_size'])
+
+
+class SearchCache:
+    # 検索結果の TTL 付き LRU キャッシュ。
+    # 値は (商品IDリスト, attribution_token) などの不変オブジェクトを想定している。
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key):
+        # 統計や LRU の順序を変えずに有効なエントリを返す
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def invalidate_products(self, product_ids):
+        # 指定した商品を含む検索結果だけを捨てる(価格・在庫の差分反映時)
+        with self._lock:
+            keys = [key for key, (_, value) in self._data.items()
+                    if not product_ids.isdisjoint(value.product_ids)]
+            for key in keys:
+                del self._data[key]
+            self.invalidations += len(keys)
+        return len(keys)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # 同じキーの同時リクエストをまとめ、最初の呼び出しだけが fn を実行する。
+    # 後続の呼び出しはその結果(または例外)を待って受け取る。
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise TimeoutError(f'Timed out waiting for in-flight call {key!r}')
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+            }
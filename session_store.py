@@ -0,0 +1,328 @@
+import re
+import secrets
+import threading
+import time
+from collections.abc import MutableMapping
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+
+import db
+
+# サーバー側セッション。Cookie にはセッション ID だけを入れ、中身(カートなど)はストアに置く。
+# セッションは各値を「フィールド」(文字列 -> JSON 文字列)に展開して保存する。
+# dict の値は 1 要素 1 フィールド(cart/<商品ID> など)にするので、カートを 1 行変えても
+# 書き込むのはその 1 フィールドだけ。読み込みはリクエストで最初に session に触れたときに行い、
+# 触れなかったリクエストではストアに一切アクセスしない。保存時は読み込んだ時点との差分だけを書く。
+#
+# ストアは 2 種類:
+#   SQLiteSessionStore  sessions.db(WAL)。ワーカーのスレッド間・再起動後も共有される
+#   MemorySessionStore  プロセス内の辞書。Redis のハッシュと同じ操作(HGETALL / HSET + HDEL +
+#                       EXPIREAT / DEL)だけを使うので、インスタンス間で共有するなら Redis に置き換えられる
+# どちらも 1 インスタンスの中でしか共有されない。Cloud Run のように複数インスタンスに
+# 振り分けられる環境では使わない(app.py の既定は Cookie セッションのまま)
+
+FIELD_SEP = '/'   # セッションのキーには使わないこと
+SID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{43}$')   # secrets.token_urlsafe(32)
+PURGE_INTERVAL = 300   # 期限切れセッションを掃除する間隔(秒)
+
+_serializer = TaggedJSONSerializer()
+
+
+def new_sid():
+    return secrets.token_urlsafe(32)
+
+
+def encode_fields(data):
+    fields = {}
+    for key, value in data.items():
+        if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+            # 空の dict も残るように目印のフィールドを置く
+            fields[key + FIELD_SEP] = '{}'
+            for sub, item in value.items():
+                fields[key + FIELD_SEP + sub] = _serializer.dumps(item)
+        else:
+            fields[key] = _serializer.dumps(value)
+    return fields
+
+
+def decode_fields(fields):
+    data = {}
+    for field, value in fields.items():
+        key, sep, sub = field.partition(FIELD_SEP)
+        if not sep:
+            data[key] = _serializer.loads(value)
+            continue
+        entries = data.setdefault(key, {})
+        if sub:
+            entries[sub] = _serializer.loads(value)
+    return data
+
+
+class ServerSideSession(SessionMixin, MutableMapping):
+    def __init__(self, store, sid=None, initial=None):
+        self.store = store
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        self.expires = None
+        self._data = None
+        self._fields = {}   # 読み込んだ時点のフィールド(保存時の差分の基準)
+        if initial:
+            # Cookie セッションからの移行分。保存時にすべて書き込まれる
+            self._data = dict(initial)
+            self.modified = True
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def _load(self):
+        if self._data is None:
+            loaded = self.store.load(self.sid) if self.sid else None
+            if loaded is None:
+                # 期限切れ・不明な ID は使わず、保存するときに新しい ID を発行する
+                self.new = True
+                self._fields = {}
+            else:
+                self._fields, self.expires = loaded
+            self._data = decode_fields(self._fields)
+        self.accessed = True
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def changes(self):
+        # (書き込むフィールド, 消すフィールド)
+        fields = encode_fields(self._load())
+        changed = {f: v for f, v in fields.items() if self._fields.get(f) != v}
+        removed = [f for f in self._fields if f not in fields]
+        return changed, removed
+
+
+class SQLiteSessionStore:
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            expires REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires);
+        CREATE TABLE IF NOT EXISTS session_fields (
+            session_id TEXT NOT NULL,
+            field TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (session_id, field)
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._purged_at = 0.0
+        self.loads = 0
+        self.saves = 0
+        self.deletes = 0
+        self.fields_written = 0
+        self.fields_deleted = 0
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.executescript(self.SCHEMA)
+
+    def _conn(self):
+        # スレッドごとの書き込み用接続
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = db.connect(self.path, readonly=False)
+            conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def load(self, sid, now=None):
+        now = time.time() if now is None else now
+        self.loads += 1
+        rows = self._conn().execute(
+            'SELECT s.expires, f.field, f.value FROM sessions s '
+            'LEFT JOIN session_fields f ON f.session_id = s.id WHERE s.id = ?', (sid,)).fetchall()
+        if not rows or rows[0][0] <= now:
+            return None
+        return {field: value for _, field, value in rows if field is not None}, rows[0][0]
+
+    def save(self, sid, changed, removed, expires):
+        conn = self._conn()
+        with conn:
+            conn.execute('INSERT INTO sessions (id, expires) VALUES (?, ?) '
+                         'ON CONFLICT (id) DO UPDATE SET expires = excluded.expires', (sid, expires))
+            if changed:
+                conn.executemany('INSERT OR REPLACE INTO session_fields (session_id, field, value) VALUES (?, ?, ?)',
+                                 [(sid, f, v) for f, v in changed.items()])
+            if removed:
+                conn.executemany('DELETE FROM session_fields WHERE session_id = ? AND field = ?',
+                                 [(sid, f) for f in removed])
+        self.saves += 1
+        self.fields_written += len(changed)
+        self.fields_deleted += len(removed)
+        self._maybe_purge()
+
+    def delete(self, sid):
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM session_fields WHERE session_id = ?', (sid,))
+            conn.execute('DELETE FROM sessions WHERE id = ?', (sid,))
+        self.deletes += 1
+
+    def _maybe_purge(self):
+        now = time.time()
+        if now - self._purged_at < PURGE_INTERVAL:
+            return
+        self._purged_at = now
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM session_fields WHERE session_id IN '
+                         '(SELECT id FROM sessions WHERE expires <= ?)', (now,))
+            conn.execute('DELETE FROM sessions WHERE expires <= ?', (now,))
+
+    def stats(self):
+        return {
+            'backend': 'sqlite',
+            'sessions': self._conn().execute('SELECT COUNT(*) FROM sessions').fetchone()[0],
+            'loads': self.loads,
+            'saves': self.saves,
+            'deletes': self.deletes,
+            'fields_written': self.fields_written,
+            'fields_deleted': self.fields_deleted,
+        }
+
+
+class MemorySessionStore:
+    def __init__(self):
+        self._data = {}   # sid -> (expires, {field: value})
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+        self.loads = 0
+        self.saves = 0
+        self.deletes = 0
+        self.fields_written = 0
+        self.fields_deleted = 0
+
+    def load(self, sid, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self.loads += 1
+            entry = self._data.get(sid)
+            if entry is None or entry[0] <= now:
+                return None
+            # HGETALL と同じく呼び出し側には写しを渡す
+            return dict(entry[1]), entry[0]
+
+    def save(self, sid, changed, removed, expires):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(sid)
+            fields = entry[1] if entry is not None and entry[0] > now else {}
+            fields.update(changed)
+            for f in removed:
+                fields.pop(f, None)
+            self._data[sid] = (expires, fields)
+            self.saves += 1
+            self.fields_written += len(changed)
+            self.fields_deleted += len(removed)
+            if now - self._purged_at >= PURGE_INTERVAL:
+                self._purged_at = now
+                for key in [k for k, (exp, _) in self._data.items() if exp <= now]:
+                    del self._data[key]
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+            self.deletes += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'sessions': len(self._data),
+                'loads': self.loads,
+                'saves': self.saves,
+                'deletes': self.deletes,
+                'fields_written': self.fields_written,
+                'fields_deleted': self.fields_deleted,
+            }
+
+
+def create_store(backend, db_path):
+    # 'cookie' は Flask 標準の署名付き Cookie セッション(ストアなし)
+    if backend == 'cookie':
+        return None
+    if backend == 'sqlite':
+        return SQLiteSessionStore(db_path)
+    if backend == 'memory':
+        return MemorySessionStore()
+    raise ValueError(f'Unknown session backend: {backend}')
+
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self, store, refresh_ratio=0.5):
+        self.store = store
+        # 残り期限がこの割合を切ったら、変更がなくても期限を延ばすために書き込む
+        self.refresh_ratio = refresh_ratio
+        self._cookie_sessions = SecureCookieSessionInterface()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if sid and SID_PATTERN.match(sid):
+            return ServerSideSession(self.store, sid)
+        initial = None
+        if sid:
+            # 切り替え前の Cookie セッション(署名付き)ならカートを引き継ぐ
+            initial = self._cookie_sessions.open_session(app, request)
+        return ServerSideSession(self.store, initial=initial)
+
+    def save_session(self, app, session, response):
+        name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not session.loaded:
+            # このリクエストではセッションに触れていない
+            return
+
+        if not session:
+            if session.sid is not None:
+                if not session.new:
+                    self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        changed, removed = session.changes()
+        stale = session.expires is None or session.expires - now < lifetime * self.refresh_ratio
+        if session.new:
+            session.sid = new_sid()
+        if session.new or changed or removed or stale:
+            self.store.save(session.sid, changed, removed, now + lifetime)
+
+        if session.new or self.should_set_cookie(app, session):
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app))
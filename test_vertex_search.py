@@ -0,0 +1,76 @@
+import threading
+import time
+import unittest
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from google.api_core import exceptions as api_exceptions
+
+from vertex_search import CircuitBreaker, CircuitOpenError, Hedger
+
+
+def raising(exc):
+    def fn():
+        raise exc
+    return fn
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_resource_exhausted_opens_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60.0)
+        for _ in range(3):
+            with self.assertRaises(api_exceptions.ResourceExhausted):
+                breaker.call(raising(api_exceptions.ResourceExhausted('quota exceeded')))
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.call(lambda: 'not called')
+
+    def test_overload_errors_count_as_failures(self):
+        for exc in (api_exceptions.TooManyRequests('429'), api_exceptions.BadGateway('502'),
+                    api_exceptions.GatewayTimeout('504'), api_exceptions.Unknown('unknown'),
+                    api_exceptions.RetryError('retries exhausted', None)):
+            breaker = CircuitBreaker(failure_threshold=1)
+            with self.assertRaises(type(exc)):
+                breaker.call(raising(exc))
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN, type(exc).__name__)
+
+    def test_request_errors_do_not_open_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        with self.assertRaises(api_exceptions.InvalidArgument):
+            breaker.call(raising(api_exceptions.InvalidArgument('bad filter')))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.call(lambda: 'ok'), 'ok')
+
+
+class HedgerTest(unittest.TestCase):
+    def test_attempts_share_the_deadline(self):
+        hedger = Hedger(max_ratio=1.0, initial_delay=0.05)
+        timeouts = []
+        release = threading.Event()
+
+        def slow(timeout):
+            # timeout を守らない呼び出しでも、待つのは締め切りまで
+            timeouts.append(timeout)
+            release.wait(1.0)
+            return 'late'
+
+        start = time.monotonic()
+        with self.assertRaises(FutureTimeoutError):
+            hedger.call(slow, start + 0.2)
+        elapsed = time.monotonic() - start
+        release.set()
+        self.assertLess(elapsed, 0.3)
+        self.assertEqual(len(timeouts), 2)
+        # 2 本目には残り時間だけを渡す
+        self.assertLess(timeouts[1], timeouts[0])
+        self.assertLessEqual(timeouts[0], 0.2)
+
+    def test_no_hedge_when_hedge_pool_is_busy(self):
+        hedger = Hedger(max_ratio=1.0, initial_delay=0.01, max_hedges=1)
+        hedger._hedge_slots.acquire()
+        self.assertEqual(hedger.call(lambda timeout: time.sleep(0.05) or 'ok', time.monotonic() + 1.0), 'ok')
+        self.assertEqual(hedger.stats()['hedges_fired'], 0)
+        self.assertEqual(hedger.stats()['hedges_busy'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
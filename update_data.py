@@ -1,27 +1,11 @@
-import json
+import ingest
 
 input_file = 'products_data.jsonl'
 output_file = 'products_data_fixed.jsonl'
 
-with open(input_file, 'r') as infile, open(output_file, 'w') as outfile:
-    for line in infile:
-        if not line.strip():
-            continue
-        try:
-            item = json.loads(line)
-            p_id = item.get('id')
-            
-            # Construct new image URL
-            new_image_url = f"https://ik.imagekit.io/RM/store/20160512512/assets/items/largeimages/{p_id}.jpg"
-            
-            # Update images list
-            if 'images' in item and len(item['images']) > 0:
-                item['images'][0]['uri'] = new_image_url
-            else:
-                item['images'] = [{'uri': new_image_url}]
-            
-            outfile.write(json.dumps(item) + '\n')
-        except Exception as e:
-            print(f"Error processing line: {e}")
+# 画像 URL を差し替えた JSONL を書き出す。
+# DB まで一度に取り込む場合は python3 ingest.py --rewrite-images を使う
+stages = ingest.build_stages(rewrite=True, jsonl_out=output_file, ascii_out=True, to_db=False)
+ingest.Pipeline(stages).run(ingest.read_lines(input_file))
 
 print("Done.")
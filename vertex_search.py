@@ -0,0 +1,303 @@
+import itertools
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import grpc
+from google.api_core import exceptions as api_exceptions
+from google.cloud.retail import SearchServiceClient
+from google.cloud.retail_v2.services.search_service.transports import SearchServiceGrpcTransport
+
+# gunicorn は 1 ワーカー 8 スレッドで動かすので、クライアント(=gRPC チャネル)は
+# ワーカー内で使い回す。チャネルはスレッドセーフで HTTP/2 上で多重化される。
+SEARCH_CLIENT_POOL_SIZE = int(os.environ.get('SEARCH_CLIENT_POOL_SIZE', '2'))
+
+# Keepalive so idle channels survive Cloud Run / LB idle timeouts and the
+# next search does not pay for a fresh TCP + TLS handshake.
+SEARCH_CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+    ('grpc.enable_retries', 1),
+]
+
+_clients = []
+_client_cycle = None
+_client_lock = threading.Lock()
+
+
+def _create_channel(*args, **kwargs):
+    # The transport passes its own options (message size limits); keep them
+    # and append ours.
+    options = list(kwargs.pop('options', None) or []) + SEARCH_CHANNEL_OPTIONS
+    return SearchServiceGrpcTransport.create_channel(*args, options=options, **kwargs)
+
+
+def _create_client():
+    transport = SearchServiceGrpcTransport(channel=_create_channel)
+    # チャネルは遅延接続なので、起動時に接続だけ開始しておく(完了は待たない)
+    grpc.channel_ready_future(transport.grpc_channel)
+    return SearchServiceClient(transport=transport)
+
+
+def init_clients(pool_size=None):
+    global _clients, _client_cycle
+    with _client_lock:
+        if _clients:
+            return
+        size = max(1, pool_size or SEARCH_CLIENT_POOL_SIZE)
+        _clients = [_create_client() for _ in range(size)]
+        _client_cycle = itertools.cycle(_clients)
+        print(f"Initialized {size} Vertex AI Search client(s)")
+
+
+def get_client():
+    if not _clients:
+        init_clients()
+    with _client_lock:
+        return next(_client_cycle)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # 連続したエラー(または遅すぎる呼び出し)が閾値に達したら open にして
+    # Vertex AI への呼び出しを止める。reset_timeout 経過後は half-open になり、
+    # 1 件だけ試験的に通して、成功すれば closed に戻す。
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    # 失敗として数えるのは Vertex AI 側の一時的な障害(過負荷・クォータ超過を含む)だけ。
+    # InvalidArgument などリクエスト側の誤りは数えずにそのまま投げ直す
+    # (利用者の入力ひとつで全員の検索が止まらないように)
+    TRANSIENT_ERRORS = (
+        api_exceptions.DeadlineExceeded,
+        api_exceptions.GatewayTimeout,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.BadGateway,
+        api_exceptions.InternalServerError,
+        api_exceptions.Unknown,
+        api_exceptions.TooManyRequests,   # ResourceExhausted(gRPC のクォータ超過)もこれのサブクラス
+        api_exceptions.RetryError,        # リトライを使い切った
+        TimeoutError,
+        FutureTimeoutError,
+    )
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, slow_call_threshold=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_threshold = slow_call_threshold
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.opened = 0
+
+    def _allow(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self.rejected += 1
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def _record(self, ok):
+        with self._lock:
+            self._probe_in_flight = False
+            if ok:
+                self._failures = 0
+                self.state = self.CLOSED
+                return
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                    print(f"Search circuit breaker opened after {self._failures} failure(s)")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def _release(self):
+        # 成否を判断できない結果だった。half-open の試験枠だけ空けて状態は変えない
+        with self._lock:
+            self._probe_in_flight = False
+
+    def call(self, fn):
+        if not self._allow():
+            raise CircuitOpenError('Vertex AI Search circuit breaker is open')
+        start = time.monotonic()
+        try:
+            result = fn()
+        except self.TRANSIENT_ERRORS:
+            self._record(False)
+            raise
+        except BaseException:
+            self._release()
+            raise
+        elapsed = time.monotonic() - start
+        # 成功しても遅い呼び出しは失敗として数える(結果自体は使う)
+        slow = self.slow_call_threshold is not None and elapsed > self.slow_call_threshold
+        self._record(not slow)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self._failures,
+                'opened': self.opened,
+                'rejected': self.rejected,
+            }
+
+
+class Hedger:
+    # ヘッジリクエスト: 最初の呼び出しが最近のレイテンシの percentile を超えても
+    # 返ってこなければ、同じリクエストをもう 1 本投げて先に返った方を使う。
+    # 追加負荷は max_ratio (全リクエストに対するヘッジの割合) で上限を設ける。
+    # fn(timeout) には締め切りまでの残り時間を渡すので、ヘッジを足しても全体は
+    # 締め切りを超えない。ヘッジは最初の呼び出しとは別のスレッドプール(max_hedges 本)で
+    # 動かし、埋まっていればヘッジしない(負荷が高いときに最初の呼び出しをヘッジの後ろに
+    # 並ばせない)。最初の呼び出し用のプールはリクエストのスレッド数に合わせる。
+
+    def __init__(self, percentile=95, max_ratio=0.1, min_delay=0.05,
+                 initial_delay=0.5, window=200, min_samples=20, max_workers=8, max_hedges=2):
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='search-primary')
+        self._hedge_executor = ThreadPoolExecutor(max_workers=max_hedges,
+                                                  thread_name_prefix='search-hedge')
+        self._hedge_slots = threading.BoundedSemaphore(max_hedges)
+        self.requests = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.hedges_suppressed = 0
+        self.hedges_busy = 0
+
+    def hedge_delay(self):
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.initial_delay
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    def _timed(self, fn, deadline):
+        start = time.monotonic()
+        result = fn(max(0.0, deadline - start))
+        with self._lock:
+            self._latencies.append(time.monotonic() - start)
+        return result
+
+    def _may_hedge(self):
+        with self._lock:
+            if self.hedges_fired + 1 > self.max_ratio * self.requests:
+                self.hedges_suppressed += 1
+                return False
+        if not self._hedge_slots.acquire(blocking=False):
+            with self._lock:
+                self.hedges_busy += 1
+            return False
+        with self._lock:
+            self.hedges_fired += 1
+        return True
+
+    def _hedged(self, fn, deadline):
+        try:
+            return self._timed(fn, deadline)
+        finally:
+            self._hedge_slots.release()
+
+    def call(self, fn, deadline):
+        # fn(timeout) を deadline(time.monotonic() の値)までに返す。間に合わなければ TimeoutError
+        with self._lock:
+            self.requests += 1
+        primary = self._executor.submit(self._timed, fn, deadline)
+        delay = min(self.hedge_delay(), max(0.0, deadline - time.monotonic()))
+        done, _ = wait([primary], timeout=delay)
+        if done or time.monotonic() >= deadline or not self._may_hedge():
+            return primary.result(timeout=max(0.0, deadline - time.monotonic()))
+
+        try:
+            hedge = self._hedge_executor.submit(self._hedged, fn, deadline)
+        except RuntimeError:
+            # 終了処理中
+            self._hedge_slots.release()
+            return primary.result(timeout=max(0.0, deadline - time.monotonic()))
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                raise FutureTimeoutError('Search deadline exceeded while waiting for hedged calls')
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        with self._lock:
+                            self.hedges_won += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def stats(self):
+        delay = self.hedge_delay()
+        with self._lock:
+            return {
+                'delay': delay,
+                'requests': self.requests,
+                'hedges_fired': self.hedges_fired,
+                'hedges_won': self.hedges_won,
+                'hedges_suppressed': self.hedges_suppressed,
+                'hedges_busy': self.hedges_busy,
+                'samples': len(self._latencies),
+            }
+
+
+# 並び順 -> SearchRequest.order_by
+SEARCH_ORDER_BY = {
+    'relevance': '',
+    'price_asc': 'price',
+    'price_desc': 'price desc',
+}
+
+
+def _price_bound(value):
+    # 有限の数だけを境界にする(inf/nan は 'infi'/'nani' という不正な式になる)
+    if value is None or not math.isfinite(float(value)):
+        return '*'
+    return f'{float(value)}i'
+
+
+def build_filter(filters):
+    # catalog.ProductFilter を Retail API の filter 式に変換する
+    # 例: price: IN(10.0i, 50.0i) AND availability: ANY("IN_STOCK")
+    clauses = []
+    low = _price_bound(filters.min_price)
+    high = _price_bound(filters.max_price)
+    if low != '*' or high != '*':
+        clauses.append(f'price: IN({low}, {high})')
+    if filters.availability:
+        clauses.append(f'availability: ANY("{filters.availability}")')
+    return ' AND '.join(clauses)